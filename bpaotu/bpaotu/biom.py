@@ -3,20 +3,19 @@ import datetime
 import itertools
 import json
 import logging
-import os
-import zipstream
 
 from .query import (
     SampleOTU,
     SampleQuery,
     OntologyInfo)
-from .util import val_or_empty, make_timestamp, empty_to_none
+from .util import val_or_empty, parse_timestamp, empty_to_none
 from .otu import SampleContext
+from .zipbuilder import make_zip_file
 
 logger = logging.getLogger('rainbow')
 
 
-def generate_biom_file(query, comment):
+def generate_biom_file(query, comment, date=None):
     otu_to_row = {}
     sample_to_column = {}
 
@@ -26,37 +25,29 @@ def generate_biom_file(query, comment):
     shape = (str(len(x)) for x in (otu_to_row, sample_to_column))
 
     return itertools.chain(
-        biom_header(comment),
+        biom_header(comment, date),
         wrap('"rows": [', otus, '],\n'),
         wrap('"columns": [', samples, '],\n'),
         wrap('"shape": [', shape, '],\n'),
         wrap('"data": [', abundance_table, ']}\n'))
 
 
-def biom_zip_file_generator(params, timestamp):
-    zf = zipstream.ZipFile(mode='w', compression=zipstream.ZIP_DEFLATED)
+def biom_zip_file_generator(params, timestamp, compression=None):
+    zf = make_zip_file(compression)
     with SampleQuery(params) as query:
         zf.write_iter(
             params.filename(timestamp, '.biom'),
-            (s.encode('utf8') for s in generate_biom_file(query, params.describe())))
+            (s.encode('utf8') for s in generate_biom_file(
+                query, params.describe(), parse_timestamp(timestamp).isoformat())))
     return zf
 
 
-def save_biom_zip_file(params, dir='/data'):
-    timestamp = make_timestamp()
-
-    filename = os.path.join(dir, params.filename(timestamp, '.biom.zip'))
-    zf = biom_zip_file_generator(params, timestamp)
-    with open(filename, 'wb') as f:
-        for data in zf:
-            f.write(data)
-    return filename
-
-
-def biom_header(comment):
+def biom_header(comment, date=None):
     '''
     Write out the JSON file header first
     '''
+    if date is None:
+        date = datetime.datetime.now().replace(microsecond=0).isoformat()
     biom_file = OrderedDict((
         ('id', None),
         ('format', 'Biological Observation Matrix 1.0.0'),
@@ -64,7 +55,7 @@ def biom_header(comment):
         ('type', 'OTU table'),
         ('comment', comment),
         ('generated_by', 'Bioplatforms Australia'),
-        ('date', datetime.datetime.now().replace(microsecond=0).isoformat()),
+        ('date', date),
         ('matrix_type', 'sparse'),
         ('matrix_element_type', 'int')))
 
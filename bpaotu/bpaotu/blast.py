@@ -5,20 +5,42 @@ import os.path
 import shutil
 import subprocess
 from contextlib import suppress
+from itertools import islice
 
-import zipstream
+import sqlalchemy
 from django.conf import settings
+from sqlalchemy.dialects.postgresql import ARRAY
 
 from . import views
-from .otu import OTU, SampleContext, SampleOTU
-from .query import SampleQuery
+from .blastdb import database_shards, ensure_databases, parse_otu_sequence_id
+from .otu import OTU, OTUAmplicon, SampleContext, SampleOTU
+from .query import Session, SampleQuery, apply_op_and_val_filter, metadata_uuid
 from .util import format_sample_id
+from .zipbuilder import make_zip_file
 
 logger = logging.getLogger('rainbow')
 
+# rows of the BLAST result join are fetched, and written out, in batches of this size
+RESULT_BATCH_SIZE = 10000
+
+
+def otu_id_table(otu_ids):
+    """
+    a subquery with a single column, `otu_id`: the IDs passed in. the IDs are sent
+    as one array parameter and unnested by the database, rather than as an IN
+    list with a literal per ID.
+    """
+    ids = sqlalchemy.bindparam('otu_ids', value=list(otu_ids), type_=ARRAY(sqlalchemy.Integer))
+    return sqlalchemy.select([sqlalchemy.func.unnest(ids).label('otu_id')]).alias('otu_ids')
+
 
 class BlastWrapper:
+    # columns of the results CSV: `qlen` is the length of the OTU, `slen` of the
+    # user's sequence
     BLAST_COLUMNS = ['qlen', 'slen', 'length', 'pident', 'evalue', 'bitscore']
+    # the user's sequence is the BLAST query, and the OTUs the subjects: so
+    # the lengths are swapped to give BLAST_COLUMNS
+    BLAST_OUTPUT_COLUMNS = ['slen', 'qlen', 'length', 'pident', 'evalue', 'bitscore']
     PERC_IDENTITY = '95'
 
     def __init__(self, cwd, submission_id, search_string, query):
@@ -28,11 +50,36 @@ class BlastWrapper:
         self._params, _ = views.param_to_filters(query)
 
     def setup(self):
-        self._make_database()
+        """
+        returns the number of database shards to be searched: each is searched
+        with run_shard(), after which merge() combines the results.
+        """
+        ensure_databases(metadata_uuid())
         self._write_query()
-
-    def run(self):
-        self._execute_blast()
+        return len(self._databases())
+
+    def run_shard(self, shard):
+        databases = self._databases()
+        path, _ = databases[shard]
+        # e-values are computed against the size of all the shards searched,
+        # not just this one, so that hits are comparable across shards
+        self._run(self._blast_command(path, self._database_size(databases), self._shard_output(shard)))
+
+    def merge(self, shards):
+        """
+        combine the output of each shard, and write out the results. returns the
+        filename of the results
+        """
+        # each shard returns up to BLAST_MAX_TARGET_SEQS hits: keep the best of them
+        hits = []
+        for shard in range(shards):
+            with open(self._in(self._shard_output(shard))) as shard_fd:
+                hits.extend(csv.reader(shard_fd, dialect='excel-tab'))
+        evalue = 1 + self.BLAST_OUTPUT_COLUMNS.index('evalue')
+        bitscore = 1 + self.BLAST_OUTPUT_COLUMNS.index('bitscore')
+        hits.sort(key=lambda row: (float(row[evalue]), -float(row[bitscore])))
+        with open(self._in('results.out'), 'w') as out_fd:
+            csv.writer(out_fd, dialect='excel-tab').writerows(hits[:settings.BLAST_MAX_TARGET_SEQS])
         return self._write_output()
 
     def cleanup(self):
@@ -48,62 +95,82 @@ class BlastWrapper:
     def _run(self, args):
         subprocess.run(args, check=True, cwd=self._cwd)
 
-    def _make_database(self):
+    def _write_query(self):
         # write user-provided search string into FASTA file
         with open(self._in('search.fasta'), 'w') as fd:
             fd.write('> user provided search string\n{}\n'.format(self._search_string))
-        # generate a blast database
-        self._run(
-            ['makeblastdb', '-in', 'search.fasta', '-dbtype', 'nucl', '-parse_seqids'])
 
-    def _write_query(self):
-        with open(self._in('everything.fasta'), 'w') as fasta_fd:
-            # write out the OTU database in FASTA format, as well a
-            # mapping table to get back to the OTU strings
-            with SampleQuery(self._params) as query:
-                q = query.matching_otus()
-                for idx, otu in enumerate(q.yield_per(50)):
-                    fasta_fd.write('> id_{}\n{}\n\n'.format(otu.id, otu.code))
-
-    def _blast_command(self):
+    @staticmethod
+    def _shard_output(shard):
+        return 'results_{}.out'.format(shard)
+
+    def _databases(self):
+        """
+        the OTU database shards (built at import) to search, as [(path, total
+        sequence length), ...]: only those of the amplicons matching the amplicon
+        filter. the rest of the query is applied to the hits.
+        """
+        session = Session()
+        try:
+            q = session.query(OTUAmplicon.id).order_by(OTUAmplicon.id)
+            q = apply_op_and_val_filter(OTUAmplicon.id, q, self._params.taxonomy_filter.amplicon_filter)
+            amplicon_ids = [t[0] for t in q]
+        finally:
+            session.close()
+        return database_shards(metadata_uuid(), amplicon_ids)
+
+    @staticmethod
+    def _database_size(databases):
+        return sum(length for _, length in databases)
+
+    def _blast_command(self, databases, dbsize, output='results.out'):
         return [
-            'blastn', '-db', 'search.fasta', '-query', 'everything.fasta', '-out', 'results.out',
-            '-outfmt', '6 qseqid {}'.format(' '.join(self.BLAST_COLUMNS)), '-perc_identity', self.PERC_IDENTITY]
-
-    def _execute_blast(self):
-        self._run(self._blast_command())
+            'blastn', '-db', databases, '-dbsize', str(dbsize), '-query', 'search.fasta', '-out', output,
+            '-outfmt', '6 sseqid {}'.format(' '.join(self.BLAST_OUTPUT_COLUMNS)),
+            '-perc_identity', self.PERC_IDENTITY,
+            '-max_target_seqs', str(settings.BLAST_MAX_TARGET_SEQS),
+            '-max_hsps', '1',
+            '-num_threads', str(settings.BLAST_THREADS)]
 
     def _blast_results(self):
         results = {}
         with open(self._in('results.out')) as results_fd:
             reader = csv.reader(results_fd, dialect='excel-tab')
             for row in reader:
-                otu_id = int(row[0][3:])  # strip id_
-                results[otu_id] = row[1:]
+                results[parse_otu_sequence_id(row[0])] = row[1:]
         return results
 
     def _rewritten_blast_result_rows(self):
         fd = io.StringIO()
         blast_rows = self._blast_results()
+        writer = csv.writer(fd)
+        writer.writerow(['OTU', 'sample_id', 'abundance', 'latitude', 'longitude'] + self.BLAST_COLUMNS)
+        yield fd.getvalue().encode('utf8')
+        fd.seek(0)
+        fd.truncate(0)
+        if not blast_rows:
+            return
+        hits = otu_id_table(blast_rows.keys())
         with SampleQuery(self._params) as query:
-            q = query.matching_sample_otus(OTU, SampleOTU, SampleContext)
-            q = q.filter(OTU.id.in_(blast_rows.keys()))
-            writer = csv.writer(fd)
-            writer.writerow(['OTU', 'sample_id', 'abundance', 'latitude', 'longitude'] + self.BLAST_COLUMNS)
-            yield fd.getvalue().encode('utf8')
-            fd.seek(0)
-            fd.truncate(0)
-            for otu, sample_otu, sample_context in q.yield_per(50):
-                blast_row = blast_rows[otu.id]
-                writer.writerow(
-                    [otu.code, format_sample_id(sample_context.id), sample_otu.count,
-                     sample_context.latitude, sample_context.longitude] + blast_row)
+            # only the columns required, joined against the hits
+            q = query.matching_sample_otus(
+                OTU.id, OTU.code, SampleOTU.sample_id, SampleOTU.count,
+                SampleContext.latitude, SampleContext.longitude)
+            q = q.filter(OTU.id == hits.c.otu_id)
+            rows = iter(q.yield_per(RESULT_BATCH_SIZE))
+            while True:
+                batch = list(islice(rows, RESULT_BATCH_SIZE))
+                if not batch:
+                    break
+                writer.writerows(
+                    [code, format_sample_id(sample_id), count, latitude, longitude] + blast_rows[otu_id]
+                    for otu_id, code, sample_id, count, latitude, longitude in batch)
                 yield fd.getvalue().encode('utf8')
                 fd.seek(0)
                 fd.truncate(0)
 
     def _write_output(self):
-        zf = zipstream.ZipFile(mode='w', compression=zipstream.ZIP_DEFLATED)
+        zf = make_zip_file()
         zf.writestr('info.txt', self._info_text(self._params))
         zf.write_iter('blast_results.csv', self._rewritten_blast_result_rows())
 
@@ -118,6 +185,7 @@ class BlastWrapper:
         return fname
 
     def _info_text(self, params):
+        databases = self._databases()
         return """\
 Australian Microbiome OTU Database - BLAST query results
 --------------------------------------------------------
@@ -129,4 +197,8 @@ Query command line:
 {}
 
 {}
-""".format(self._search_string, ' '.join(self._blast_command()), params.describe()).encode('utf8')
+""".format(
+            self._search_string,
+            ' '.join(self._blast_command(
+                ' '.join(path for path, _ in databases), self._database_size(databases))),
+            params.describe()).encode('utf8')
@@ -0,0 +1,145 @@
+import fcntl
+import json
+import logging
+import os
+import shutil
+import subprocess
+from contextlib import suppress
+from glob import glob
+from itertools import islice
+
+from django.conf import settings
+from sqlalchemy.orm import sessionmaker
+
+from .otu import OTU, OTUAmplicon, make_engine
+
+logger = logging.getLogger("rainbow")
+
+
+# the BLAST databases of all OTU codes are built for each import (by the
+# importer) under BLAST_DB_PATH/<import UUID>/. each amplicon is split into
+# shards of at most BLAST_DB_SHARD_SIZE sequences, so that a search may be
+# run in parallel across workers. the manifest lists the shards of each
+# amplicon, and their total sequence length; it is written last, so its
+# presence marks the databases complete.
+DB_PREFIX = 'amplicon_'
+MANIFEST_FILE = 'manifest.json'
+LOCK_FILE = 'lock'
+
+
+def database_dir(import_uuid):
+    return os.path.join(settings.BLAST_DB_PATH, import_uuid)
+
+
+def _shard_name(amplicon_id, shard):
+    return '{}{}_{}'.format(DB_PREFIX, amplicon_id, shard)
+
+
+def database_shards(import_uuid, amplicon_ids):
+    "[(path, total sequence length), ...] of the database shards of the given amplicons"
+    target_dir = database_dir(import_uuid)
+    with open(os.path.join(target_dir, MANIFEST_FILE)) as fd:
+        manifest = json.load(fd)
+    return [
+        (os.path.join(target_dir, shard['name']), shard['length'])
+        for amplicon_id in amplicon_ids
+        for shard in manifest.get(str(amplicon_id), [])]
+
+
+def otu_sequence_id(otu_id):
+    return 'id_{}'.format(otu_id)
+
+
+def parse_otu_sequence_id(seqid):
+    # with -parse_seqids, the ID may be reported with a local ID prefix
+    if seqid.startswith('lcl|'):
+        seqid = seqid[4:]
+    return int(seqid[3:])  # strip id_
+
+
+def _make_shard(target_dir, name, title, sequences):
+    "returns the total length of the sequences in the shard"
+    db_path = os.path.join(target_dir, name)
+    fasta_path = db_path + '.fasta'
+    length = 0
+    try:
+        with open(fasta_path, 'w') as fasta_fd:
+            for otu_id, code in sequences:
+                fasta_fd.write('>{}\n{}\n'.format(otu_sequence_id(otu_id), code))
+                length += len(code)
+        subprocess.run(
+            ['makeblastdb', '-in', fasta_path, '-dbtype', 'nucl', '-parse_seqids', '-out', db_path,
+             '-title', title],
+            check=True, cwd=target_dir)
+    finally:
+        with suppress(FileNotFoundError):
+            os.unlink(fasta_path)
+    return length
+
+
+def build_databases(session, import_uuid):
+    """
+    write out the OTU codes for each amplicon in FASTA format, in shards of
+    equal size, and build a BLAST nucleotide database from each. databases
+    of previous imports are removed.
+    """
+    target_dir = database_dir(import_uuid)
+    os.makedirs(target_dir, exist_ok=True)
+    shard_size = settings.BLAST_DB_SHARD_SIZE
+    manifest = {}
+    amplicons = session.query(OTUAmplicon.id, OTUAmplicon.value).order_by(OTUAmplicon.id).all()
+    for amplicon_id, amplicon in amplicons:
+        count = session.query(OTU.id).filter(OTU.amplicon_id == amplicon_id).count()
+        if count == 0:
+            continue
+        # balance the shards, rather than leaving a small remainder
+        shards = -(-count // shard_size)
+        per_shard = -(-count // shards)
+        logger.warning('building BLAST database for amplicon: {} ({} OTUs, {} shards)'.format(
+            amplicon, count, shards))
+        q = session.query(OTU.id, OTU.code).filter(OTU.amplicon_id == amplicon_id).order_by(OTU.id)
+        rows = iter(q.yield_per(10000))
+        amplicon_shards = []
+        for shard in range(shards):
+            name = _shard_name(amplicon_id, shard)
+            length = _make_shard(
+                target_dir, name, '{} ({}/{})'.format(amplicon, shard + 1, shards), islice(rows, per_shard))
+            amplicon_shards.append({'name': name, 'length': length})
+        manifest[str(amplicon_id)] = amplicon_shards
+    with open(os.path.join(target_dir, MANIFEST_FILE), 'w') as fd:
+        json.dump(manifest, fd)
+    remove_stale_databases(import_uuid)
+
+
+def remove_stale_databases(import_uuid):
+    current_dir = database_dir(import_uuid)
+    for path in glob(os.path.join(settings.BLAST_DB_PATH, '*')):
+        if path != current_dir and os.path.isdir(path):
+            logger.info('removing BLAST databases of previous import: {}'.format(path))
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def ensure_databases(import_uuid):
+    """
+    the databases are normally built at import time; if they're missing (e.g.
+    they were removed, or the import predates them), build them now. a lock
+    ensures only one process builds them.
+    """
+    target_dir = database_dir(import_uuid)
+    if os.path.exists(os.path.join(target_dir, MANIFEST_FILE)):
+        return
+    os.makedirs(target_dir, exist_ok=True)
+    with open(os.path.join(target_dir, LOCK_FILE), 'w') as lock_fd:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(os.path.join(target_dir, MANIFEST_FILE)):
+                return
+            logger.warning('BLAST databases missing for import {}, building'.format(import_uuid))
+            session = sessionmaker(bind=make_engine())()
+            try:
+                build_databases(session, import_uuid)
+            finally:
+                session.close()
+        finally:
+            with suppress(OSError):
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
@@ -0,0 +1,151 @@
+import logging
+import os
+import tempfile
+from contextlib import suppress
+from glob import glob
+
+from django.conf import settings
+
+from .query import metadata_uuid
+
+logger = logging.getLogger("rainbow")
+
+
+READ_CHUNK_SIZE = 1024 * 1024
+PARTIAL_SUFFIX = '.part'
+
+
+class ExportCache:
+    """
+    on-disk cache of finished export artifacts (.biom.zip, -csv.zip)
+
+    entries are content-addressed: they live under the UUID of the current
+    import, named by the `state_key` of the query which produced them. the
+    timestamp the artifact was generated at is part of the entry name, so that
+    a cache hit is served with the same filename it was originally generated
+    with (the timestamp also appears within the artifact.)
+
+    the cache is bounded by `settings.EXPORT_CACHE_QUOTA` bytes; least recently
+    used entries are evicted first. entries from previous imports are always
+    evicted before entries from the current import.
+    """
+
+    def __init__(self, base_dir=None, quota=None):
+        self._base_dir = base_dir or settings.EXPORT_CACHE_PATH
+        self._quota = settings.EXPORT_CACHE_QUOTA if quota is None else quota
+
+    @property
+    def enabled(self):
+        return self._quota > 0
+
+    def _import_dir(self):
+        return os.path.join(self._base_dir, metadata_uuid())
+
+    @staticmethod
+    def _key(params, variant):
+        if variant:
+            return '{}~{}'.format(params.state_key, variant)
+        return params.state_key
+
+    def lookup(self, params, extension, variant=None):
+        """
+        returns (path, timestamp) for a cached artifact, or None
+        """
+        key = self._key(params, variant)
+        pattern = os.path.join(self._import_dir(), '{}-*{}'.format(key, extension))
+        for path in glob(pattern):
+            timestamp = os.path.basename(path)[len(key) + 1:-len(extension)]
+            # touch the entry: mtime is used to determine LRU order for eviction
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                # evicted underneath us
+                continue
+            return path, timestamp
+        return None
+
+    def _read(self, path):
+        with open(path, 'rb') as fd:
+            while True:
+                data = fd.read(READ_CHUNK_SIZE)
+                if not data:
+                    break
+                yield data
+
+    def _write_through(self, params, extension, variant, timestamp, chunks):
+        """
+        yield from `chunks`, while also writing them into the cache. the entry
+        only becomes visible once the artifact is complete: if the consumer
+        stops early (e.g. the client disconnects) the partial file is removed.
+        """
+        target_dir = self._import_dir()
+        os.makedirs(target_dir, exist_ok=True)
+        entry_name = '{}-{}{}'.format(self._key(params, variant), timestamp, extension)
+        fd, partial_path = tempfile.mkstemp(dir=target_dir, prefix=entry_name, suffix=PARTIAL_SUFFIX)
+        complete = False
+        try:
+            with os.fdopen(fd, 'wb') as cache_fd:
+                for chunk in chunks:
+                    cache_fd.write(chunk)
+                    yield chunk
+            os.replace(partial_path, os.path.join(target_dir, entry_name))
+            complete = True
+        finally:
+            if not complete:
+                with suppress(OSError):
+                    os.unlink(partial_path)
+        self.evict()
+
+    def export(self, params, extension, generate, timestamp, variant=None):
+        """
+        returns (iterator over the artifact's bytes, timestamp)
+
+        `generate(timestamp)` must return an iterable of bytes making up the
+        artifact; it is only called on a cache miss. `variant` distinguishes
+        different renderings of the same query (e.g. compression level)
+        """
+        if not self.enabled:
+            return generate(timestamp), timestamp
+        hit = self.lookup(params, extension, variant)
+        if hit is not None:
+            path, cached_timestamp = hit
+            logger.info('export cache hit: {}'.format(path))
+            return self._read(path), cached_timestamp
+        return self._write_through(params, extension, variant, timestamp, generate(timestamp)), timestamp
+
+    def _entries(self):
+        current_dir = self._import_dir()
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self._base_dir):
+            for filename in filenames:
+                if filename.endswith(PARTIAL_SUFFIX):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((dirpath == current_dir, st.st_mtime, st.st_size, path))
+        return entries
+
+    def evict(self):
+        entries = self._entries()
+        total = sum(size for _, _, size, _ in entries)
+        # stale imports first, then oldest access first
+        for _, _, size, path in sorted(entries):
+            if total <= self._quota:
+                break
+            logger.info('export cache evicting: {}'.format(path))
+            with suppress(FileNotFoundError):
+                os.unlink(path)
+            total -= size
+        # tidy up directories left behind by previous imports
+        current_dir = self._import_dir()
+        for path in glob(os.path.join(self._base_dir, '*')):
+            if path != current_dir and os.path.isdir(path):
+                with suppress(OSError):
+                    os.rmdir(path)
+
+
+def cached_export(params, extension, generate, timestamp, variant=None):
+    return ExportCache().export(params, extension, generate, timestamp, variant)
@@ -3,19 +3,26 @@ import logging
 import os
 import random
 import string
+import threading
 import time
+import uuid
 
 import requests
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 
+from .http_client import get_session
 
 logger = logging.getLogger("rainbow")
 
 
+class GalaxyAuthError(Exception):
+    pass
+
+
 class GalaxyClient:
-    def __init__(self, base_url=None, api_key=None):
+    def __init__(self, base_url=None, api_key=None, on_auth_error=None):
         self.base_url = base_url or settings.GALAXY_BASE_URL
         self.api_key = api_key or settings.GALAXY_ADMIN_USER_API_KEY
         if not self.base_url:
@@ -23,6 +30,18 @@ class GalaxyClient:
         if not self.api_key:
             raise Exception("You have to specify api_key if settings.GALAXY_ADMIN_USER_API_KEY is not configured")
         self.api_url = os.path.join(self.base_url, 'api')
+        self.session = get_session()
+        # called if Galaxy rejects the API key
+        self.on_auth_error = on_auth_error
+
+    def _check_response(self, response):
+        if response.status_code in (requests.codes.unauthorized, requests.codes.forbidden):
+            if self.on_auth_error is not None:
+                self.on_auth_error()
+            raise GalaxyAuthError('Galaxy Error: %s' % response.text)
+        if response.status_code != requests.codes.ok:
+            raise Exception('Galaxy Error: %s' % response.text)
+        return response.json()
 
     def _api_url(self, relpath):
         relpath = relpath.lstrip('/')
@@ -32,10 +51,8 @@ class GalaxyClient:
     def get(self, relpath, **kwargs):
         params = {'key': self.api_key}
         params.update(kwargs)
-        response = requests.get(self._api_url(relpath), params=params)
-        if response.status_code != requests.codes.ok:
-            raise Exception('Galaxy Error: %s' % response.text)
-        return response.json()
+        response = self.session.get(self._api_url(relpath), params=params)
+        return self._check_response(response)
 
     def post(self, relpath, **kwargs):
         return self.post_ll(relpath, data=kwargs)
@@ -45,23 +62,54 @@ class GalaxyClient:
         params = {
             'key': self.api_key
         }
-        response = requests.put(
+        response = self.session.put(
             self._api_url(relpath),
             data=payload,
             params=params,
             headers={'Content-Type': 'application/json'})
-        if response.status_code != requests.codes.ok:
-            raise Exception('Galaxy Error: %s' % response.text)
-        return response.json()
+        return self._check_response(response)
+
+    def post_stream(self, relpath, fields, file_field, filename, chunks):
+        '''
+        A multipart/form-data post, with the file content streamed from the iterable
+        `chunks` (sent with chunked transfer encoding) rather than read into memory.
+        '''
+        fields = dict(fields, key=self.api_key)
+        boundary = uuid.uuid4().hex
+        response = self.session.post(
+            self._api_url(relpath),
+            data=multipart_stream(boundary, fields, file_field, filename, chunks),
+            headers={'Content-Type': 'multipart/form-data; boundary=%s' % boundary})
+        return self._check_response(response)
 
     def post_ll(self, relpath, **kwargs):
         '''A low-level post giving more control on the arguments we pass to request'''
         new_args = kwargs.copy()
         new_args.setdefault('data', {})['key'] = self.api_key
-        response = requests.post(self._api_url(relpath), **new_args)
-        if response.status_code != requests.codes.ok:
-            raise Exception('Galaxy Error: %s' % response.text)
-        return response.json()
+        response = self.session.post(self._api_url(relpath), **new_args)
+        return self._check_response(response)
+
+
+def multipart_stream(boundary, fields, file_field, filename, chunks):
+    '''
+    Generates a multipart/form-data body: the form `fields`, followed by a file
+    whose content is taken from `chunks`
+    '''
+    def part_header(disposition, extra=''):
+        return ('--%s\r\nContent-Disposition: form-data; %s\r\n%s\r\n' % (
+            boundary, disposition, extra)).encode('utf8')
+
+    for name, value in fields.items():
+        yield part_header('name="%s"' % name)
+        yield str(value).encode('utf8')
+        yield b'\r\n'
+    yield part_header(
+        'name="%s"; filename="%s"' % (file_field, filename),
+        'Content-Type: application/octet-stream\r\n')
+    for chunk in chunks:
+        if chunk:
+            yield chunk
+    yield ('\r\n--%s--\r\n' % boundary).encode('utf8')
 
 
 class GalaxyAPI:
@@ -102,25 +150,45 @@ class HistoryAPI(GalaxyAPI):
     def update(self, history):
         return self.client.put('histories/%s' % history['id'], history)
 
-    def upload_file(self, history_id, filepath, filename=None, file_type=None):
-        payload = {
-            'tool_id': 'upload1',
-            'history_id': history_id,
-        }
+    @staticmethod
+    def _upload_payload(history_id, filename, file_type):
         inputs = {
-            'files_0|NAME': filename or os.path.basename(filepath),
+            'files_0|NAME': filename,
             'files_0|type': 'upload_dataset',
             'dbkey': '?',
             'file_type': file_type or 'auto',
             'ajax_upload': 'true',
         }
-        payload['inputs'] = json.dumps(inputs)
+        return {
+            'tool_id': 'upload1',
+            'history_id': history_id,
+            'inputs': json.dumps(inputs),
+        }
 
+    def upload_file(self, history_id, filepath, filename=None, file_type=None):
+        payload = self._upload_payload(history_id, filename or os.path.basename(filepath), file_type)
         with open(filepath, 'rb') as file_to_upload:
             files = {'files_0|file_data': file_to_upload}
             response = self.client.post_ll('tools', data=payload, files=files)
             return response['outputs'][0]['id']
 
+    def upload_stream(self, history_id, chunks, filename, file_type=None):
+        '''Uploads a file whose content is generated by the iterable `chunks`, without a temporary file'''
+        payload = self._upload_payload(history_id, filename, file_type)
+        response = self.client.post_stream('tools', payload, 'files_0|file_data', filename, chunks)
+        return response['outputs'][0]['id']
+
+    def copy_dataset(self, history_id, source_history_id, dataset_id):
+        '''
+        Copies a dataset into the history, returning the ID of the copy; or None if
+        the dataset is no longer available (deleted, or not in the `ok` state.)
+        '''
+        hda_details = self.client.get('histories/%s/contents/%s' % (source_history_id, dataset_id))
+        if hda_details.get('deleted') or hda_details.get('purged') or hda_details.get('state') != 'ok':
+            return None
+        response = self.client.post('histories/%s/contents' % history_id, source='hda', content=dataset_id)
+        return response['id']
+
     def get_file_state(self, history_id, file_id):
         hda_details = self.client.get('histories/%s/contents/%s' % (history_id, file_id))
         return hda_details['state']
@@ -177,18 +245,54 @@ class WorkflowAPI(GalaxyAPI):
 
 
 class Galaxy:
-    def __init__(self, base_url=None, api_key=None):
-        self.client = GalaxyClient(base_url, api_key)
+    def __init__(self, base_url=None, api_key=None, on_auth_error=None):
+        self.client = GalaxyClient(base_url, api_key, on_auth_error)
         self.users = UserAPI(self.client)
         self.histories = HistoryAPI(self.client)
         self.workflows = WorkflowAPI(self.client)
 
 
+class GalaxyUserCache:
+    """
+    in-process cache of the Galaxy user ID and API key for an email address,
+    to save the admin round trips to resolve them on every call. entries
+    expire after settings.GALAXY_USER_CACHE_TTL seconds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, email):
+        with self._lock:
+            entry = self._entries.get(email)
+            if entry is None:
+                return None
+            expires, user_id, api_key = entry
+            if time.time() > expires:
+                del self._entries[email]
+                return None
+            return user_id, api_key
+
+    def set(self, email, user_id, api_key):
+        with self._lock:
+            self._entries[email] = (time.time() + settings.GALAXY_USER_CACHE_TTL, user_id, api_key)
+
+    def forget(self, email):
+        with self._lock:
+            self._entries.pop(email, None)
+
+
+galaxy_user_cache = GalaxyUserCache()
+
+
 def galaxy_ensure_user(email):
     """
     create a galaxy account if required. returns True if
     an account was created
     """
+    if galaxy_user_cache.get(email) is not None:
+        return False
     admins_galaxy = Galaxy()
     galaxy_user = admins_galaxy.users.get_by_email(email)
     if galaxy_user is None:
@@ -199,9 +303,16 @@ def galaxy_ensure_user(email):
 
 def get_users_galaxy(email):
     '''Returns a galaxy client configured for the user who has the passed in email address.'''
-    admins_galaxy = Galaxy()
-    users_api_key = _get_users_galaxy_api_key(admins_galaxy, email)
-    users_galaxy = Galaxy(api_key=users_api_key)
+    cached = galaxy_user_cache.get(email)
+    if cached is not None:
+        _, users_api_key = cached
+    else:
+        admins_galaxy = Galaxy()
+        user_id, users_api_key = _get_users_galaxy_api_key(admins_galaxy, email)
+        galaxy_user_cache.set(email, user_id, users_api_key)
+    # if the key has been reset (or the user removed) since it was cached, the
+    # next call resolves it again
+    users_galaxy = Galaxy(api_key=users_api_key, on_auth_error=lambda: galaxy_user_cache.forget(email))
     return users_galaxy
 
 
@@ -210,7 +321,7 @@ def _get_users_galaxy_api_key(admins_galaxy, email):
     api_key = admins_galaxy.users.get_api_key(galaxy_user['id'])
     if api_key is None:
         api_key = admins_galaxy.users.create_api_key(galaxy_user['id'])
-    return api_key
+    return galaxy_user['id'], api_key
 
 
 def make_workflow_tag(krona_shared_wfl_id):
@@ -0,0 +1,68 @@
+import logging
+import os
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger("rainbow")
+
+
+RETRY_BACKOFF_FACTOR = 0.5
+RETRY_STATUS_CODES = (502, 503, 504)
+
+# per-process session: (pid, session)
+_session = (None, None)
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    applies a default timeout to every request made through the adapter,
+    unless the caller provides one
+    """
+
+    def __init__(self, *args, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def make_session():
+    """
+    a requests.Session with keep-alive connection pools (HTTP_POOL_MAXSIZE
+    connections per host), default timeouts, and retry with backoff on
+    connection errors and gateway errors. only idempotent methods are retried
+    on a bad response: in particular, POSTs to Galaxy are never replayed.
+    """
+    retry = Retry(
+        total=settings.HTTP_MAX_RETRIES,
+        backoff_factor=RETRY_BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUS_CODES,
+        method_whitelist=Retry.DEFAULT_METHOD_WHITELIST,
+        raise_on_status=False)
+    adapter = TimeoutHTTPAdapter(
+        pool_maxsize=settings.HTTP_POOL_MAXSIZE,
+        max_retries=retry,
+        timeout=(settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT))
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """
+    the shared session for this process. sessions are not shared across a
+    fork (celery and uwsgi workers), as the pooled sockets would be.
+    """
+    global _session
+    pid, session = _session
+    if pid != os.getpid():
+        session = make_session()
+        _session = (os.getpid(), session)
+    return session
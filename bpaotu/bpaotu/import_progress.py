@@ -0,0 +1,256 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .readahead import source_reader
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+logger = logging.getLogger("rainbow")
+
+
+# progress within a stage is logged at most this often (seconds)
+LOG_INTERVAL = 30
+
+_metrics = None
+
+
+class _Metrics:
+    "prometheus gauges of import progress, labelled by stage"
+
+    def __init__(self, port):
+        def gauge(name, documentation):
+            return prometheus_client.Gauge('bpaotu_import_' + name, documentation, ['stage'])
+
+        self.rows = gauge('rows', 'rows processed')
+        self.rows_per_second = gauge('rows_per_second', 'rows processed per second')
+        self.bytes_decompressed = gauge('bytes_decompressed', 'bytes of input decompressed')
+        self.copy_bytes_per_second = gauge('copy_bytes_per_second', 'bytes sent to COPY per second')
+        self.eta_seconds = gauge('eta_seconds', 'estimated time remaining')
+        self.elapsed_seconds = gauge('elapsed_seconds', 'time elapsed')
+        prometheus_client.start_http_server(port)
+        logger.info('exporting import metrics on port {}'.format(port))
+
+    def update(self, stage):
+        self.rows.labels(stage.name).set(stage.rows)
+        self.rows_per_second.labels(stage.name).set(stage.rows_per_second())
+        self.bytes_decompressed.labels(stage.name).set(stage.bytes_decompressed)
+        self.copy_bytes_per_second.labels(stage.name).set(stage.copy_bytes_per_second())
+        self.eta_seconds.labels(stage.name).set(stage.eta() or 0)
+        self.elapsed_seconds.labels(stage.name).set(stage.elapsed())
+
+
+def _get_metrics():
+    "metrics are exported if prometheus_client is installed and IMPORT_METRICS_PORT is set"
+    global _metrics
+    if _metrics is None and prometheus_client is not None and settings.IMPORT_METRICS_PORT:
+        _metrics = _Metrics(int(settings.IMPORT_METRICS_PORT))
+    return _metrics
+
+
+def _rate(amount, seconds):
+    return amount / seconds if seconds > 0 else 0.0
+
+
+class FileProgress:
+    "progress through an input file"
+
+    def __init__(self, stage, path):
+        self._stage = stage
+        self.path = path
+        self.size = os.stat(path).st_size
+        self.rows = 0
+        self.copy_bytes = 0
+        self.copy_seconds = 0.0
+        self._reader = None
+        self._bytes_decompressed = 0
+        self._started = time.time()
+        self._finished = None
+
+    def watch(self, stream):
+        "track decompression of the file, read through `stream` (from readahead.open_gzip)"
+        self._reader = source_reader(stream)
+
+    @property
+    def bytes_decompressed(self):
+        if self._reader is not None:
+            return self._reader.bytes_decompressed
+        return self._bytes_decompressed
+
+    @property
+    def position(self):
+        "bytes of the (compressed) file read so far"
+        if self._finished is not None:
+            return self.size
+        if self._reader is not None and not self._reader.closed:
+            return self._reader.compressed_position
+        return 0
+
+    def elapsed(self):
+        return (self._finished or time.time()) - self._started
+
+    def update(self, rows):
+        "`rows` of the file have been processed"
+        self._stage.add_rows(rows - self.rows)
+        self.rows = rows
+
+    def copied(self, nbytes, seconds):
+        "`nbytes` were sent to COPY, taking `seconds`"
+        self.copy_bytes += nbytes
+        self.copy_seconds += seconds
+        self._stage.copied(nbytes, seconds)
+
+    def finish(self):
+        # the reader is closed (and its counters lost to us) with the stream
+        self._bytes_decompressed = self.bytes_decompressed
+        self._reader = None
+        self._finished = time.time()
+
+    def attrs(self):
+        "progress, as ImportedFile attributes"
+        elapsed = self.elapsed()
+        return {
+            'elapsed': elapsed,
+            'bytes_decompressed': self.bytes_decompressed,
+            'rows_per_second': _rate(self.rows, elapsed),
+        }
+
+
+class StageProgress:
+    "progress through a stage of the import, and its input files"
+
+    def __init__(self, name, paths):
+        self.name = name
+        self.rows = 0
+        self.copy_bytes = 0
+        self.copy_seconds = 0.0
+        self.total_bytes = sum(os.stat(path).st_size for path in paths)
+        self._completed_bytes = 0
+        self._completed_decompressed = 0
+        self._current = None
+        self._started = time.time()
+        self._finished = None
+        self._last_logged = self._started
+
+    @property
+    def bytes_decompressed(self):
+        current = self._current.bytes_decompressed if self._current is not None else 0
+        return self._completed_decompressed + current
+
+    def elapsed(self):
+        return (self._finished or time.time()) - self._started
+
+    def rows_per_second(self):
+        return _rate(self.rows, self.elapsed())
+
+    def copy_bytes_per_second(self):
+        return _rate(self.copy_bytes, self.copy_seconds)
+
+    def eta(self):
+        "estimated seconds remaining in the stage, by the size of the files still to be read"
+        if not self.total_bytes:
+            return None
+        done = self._completed_bytes + (self._current.position if self._current is not None else 0)
+        if done == 0:
+            return None
+        return self.elapsed() * (self.total_bytes - done) / done
+
+    @contextmanager
+    def file(self, path):
+        progress = FileProgress(self, path)
+        self._current = progress
+        try:
+            yield progress
+        finally:
+            progress.finish()
+            self._current = None
+            self._completed_bytes += progress.size
+            self._completed_decompressed += progress.bytes_decompressed
+            logger.warning('[{}] {}: {} rows in {:.1f}s ({:.0f} rows/s, {:.1f} MB decompressed)'.format(
+                self.name, os.path.basename(path), progress.rows, progress.elapsed(),
+                _rate(progress.rows, progress.elapsed()), progress.bytes_decompressed / 1e6))
+            self._report(force=True)
+
+    def add_rows(self, rows):
+        self.rows += rows
+        self._report()
+
+    def copied(self, nbytes, seconds):
+        self.copy_bytes += nbytes
+        self.copy_seconds += seconds
+
+    def _report(self, force=False):
+        now = time.time()
+        metrics = _get_metrics()
+        if metrics is not None:
+            metrics.update(self)
+        if not force and now - self._last_logged < LOG_INTERVAL:
+            return
+        self._last_logged = now
+        eta = self.eta()
+        logger.warning('[{}] progress: {} rows, {:.0f} rows/s, {:.1f} MB decompressed{}{}'.format(
+            self.name, self.rows, self.rows_per_second(), self.bytes_decompressed / 1e6,
+            ', COPY {:.1f} MB/s'.format(self.copy_bytes_per_second() / 1e6) if self.copy_bytes else '',
+            ', {:.0f}s remaining'.format(eta) if eta is not None else ''))
+
+    def finish(self):
+        self._finished = time.time()
+        self._report(force=True)
+
+    def summary(self):
+        summary = {
+            'elapsed': self.elapsed(),
+            'rows': self.rows,
+            'rows_per_second': self.rows_per_second(),
+        }
+        if self.total_bytes:
+            summary['bytes'] = self.total_bytes
+            summary['bytes_decompressed'] = self.bytes_decompressed
+        if self.copy_bytes:
+            summary['copy_bytes_per_second'] = self.copy_bytes_per_second()
+        return summary
+
+
+class ImportProgress:
+    """
+    tracks the progress and throughput of each stage of an import: logged as
+    it goes, summarised into ImportMetadata, and optionally exported to
+    prometheus
+    """
+
+    def __init__(self):
+        self._started = time.time()
+        self._stages = {}
+        self._current = None
+
+    def elapsed(self):
+        return time.time() - self._started
+
+    @contextmanager
+    def stage(self, name, paths=()):
+        "a stage of the import, reading the files at `paths`"
+        stage = StageProgress(name, paths)
+        logger.warning('[{}] starting'.format(name))
+        self._current = stage
+        try:
+            yield stage
+        finally:
+            stage.finish()
+            self._current = None
+            self._stages[name] = stage.summary()
+
+    def file(self, path):
+        "progress through a file in the current stage"
+        return self._current.file(path)
+
+    def add_rows(self, rows):
+        self._current.add_rows(rows)
+
+    def summary(self):
+        return dict(self._stages)
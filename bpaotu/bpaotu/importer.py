@@ -1,35 +1,45 @@
 import csv
 import datetime
-import gzip
+import io
+import json
 import logging
 import os
 import re
 import tempfile
+import time
 import traceback
 import uuid
+from array import array
 from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
-from hashlib import md5
-from itertools import zip_longest
+from itertools import count, zip_longest
 
+import numpy as np
+import pandas as pd
+import psycopg2
 import sqlalchemy
 from bpaingest.metadata import DownloadMetadata
 from bpaingest.projects.amdb.contextual import \
     AustralianMicrobiomeSampleContextual
 from bpaingest.projects.amdb.ingest import AccessAMDContextualMetadata
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.schema import CreateSchema, DropSchema
+from sqlalchemy.schema import CreateIndex, CreateSchema, CreateTable, DropSchema
 from sqlalchemy.sql.expression import text
 
+from .blastdb import build_databases
+from .kmer_index import build_index
 from .otu import (OTU, SCHEMA, Base, Environment, ExcludedSamples,
                   ImportedFile, ImportMetadata, OntologyErrors, OTUAmplicon,
                   OTUClass, OTUFamily, OTUGenus, OTUKingdom, OTUOrder,
                   OTUPhylum, OTUSpecies, SampleAustralianSoilClassification,
                   SampleColor, SampleContext, SampleEcologicalZone,
                   SampleFAOSoilClassification, SampleHorizonClassification,
-                  SampleLandUse, SampleOTU, SampleProfilePosition,
-                  SampleStorageMethod, SampleTillage, SampleType,
-                  SampleVegetationType, make_engine)
+                  SampleAmpliconCount, SampleLandUse, SampleOTU,
+                  SampleProfilePosition, SampleStorageMethod, SampleTaxonCount,
+                  SampleTillage, SampleType, SampleVegetationType, make_engine)
+from .import_progress import ImportProgress
+from .readahead import open_gzip
 
 logger = logging.getLogger("rainbow")
 
@@ -52,8 +62,64 @@ def grouper(iterable, n, fillvalue=None):
     return zip_longest(*args, fillvalue=fillvalue)
 
 
-def otu_hash(code, amplicon_id):
-    return md5('{},{}'.format(code, amplicon_id).encode('ascii')).digest()
+def otu_hashes(codes):
+    "64-bit hashes of a sequence of OTU codes, as an array"
+    return pd.util.hash_array(np.asarray(codes, dtype=object), categorize=False)
+
+
+class OTULookup:
+    """
+    maps (amplicon, OTU code) to OTU ID. held as a pair of arrays per amplicon:
+    the sorted 64-bit hashes of the OTU codes, and the corresponding IDs; a
+    lookup is a binary search. this is a small fraction of the size of a dict
+    keyed on digests, with tens of millions of OTUs.
+    """
+
+    # codes are hashed this many at a time as they are added
+    CHUNK_SIZE = 100000
+
+    def __init__(self):
+        # amplicon -> (hash arrays, codes not yet hashed, IDs), until finalized
+        self._pending = defaultdict(lambda: ([], [], array('q')))
+        self._hashes = {}
+        self._ids = {}
+
+    def add(self, amplicon, code, otu_id):
+        hash_arrays, codes, ids = self._pending[amplicon]
+        codes.append(code)
+        ids.append(otu_id)
+        if len(codes) >= self.CHUNK_SIZE:
+            hash_arrays.append(otu_hashes(codes))
+            codes.clear()
+
+    def finalize(self):
+        for amplicon, (hash_arrays, codes, ids) in self._pending.items():
+            if codes:
+                hash_arrays.append(otu_hashes(codes))
+            hashes = np.concatenate(hash_arrays)
+            order = np.argsort(hashes, kind='mergesort')
+            hashes = hashes[order]
+            if len(hashes) > 1 and (hashes[1:] == hashes[:-1]).any():
+                raise ImportException(
+                    "duplicate OTU code (or hash collision) in amplicon: {}".format(amplicon))
+            self._hashes[amplicon] = hashes
+            self._ids[amplicon] = np.frombuffer(ids, dtype=np.int64)[order].astype(np.int32)
+        self._pending.clear()
+
+    def lookup(self, amplicon, codes):
+        "the IDs of `codes` (an array of OTU codes) within `amplicon`, as an array"
+        try:
+            hashes = self._hashes[amplicon]
+        except KeyError:
+            raise ImportException("no OTUs loaded for amplicon: {}".format(amplicon))
+        query = otu_hashes(codes)
+        idx = np.searchsorted(hashes, query)
+        idx[idx == len(hashes)] = 0
+        missing = hashes[idx] != query
+        if missing.any():
+            raise ImportException("unknown OTU code in amplicon {}: {}".format(
+                amplicon, codes[int(np.argmax(missing))]))
+        return self._ids[amplicon][idx]
 
 
 class DataImporter:
@@ -75,13 +141,44 @@ class DataImporter:
         ('color', SampleColor),
     ])
 
-    def __init__(self, import_base, revision_date):
+    # progress through taxonomy files is reported every this many rows
+    PROGRESS_ROWS = 100000
+    # sample contextual metadata is inserted in batches of this many rows
+    CONTEXTUAL_BATCH_SIZE = 1000
+    # abundance tables are parsed and loaded this many rows at a time
+    ABUNDANCE_CHUNK_SIZE = 1000000
+    # the bulk loaded tables. with deferred indexes, these are created without
+    # secondary indexes or foreign keys, which are added once they're loaded.
+    # if unlogged, they are not written to the WAL until the import completes.
+    BULK_TABLES = (OTU, SampleOTU, SampleAmpliconCount, SampleTaxonCount)
+    # connections used to build deferred indexes in parallel, and the memory
+    # each may use to do so
+    INDEX_BUILD_CONCURRENCY = 4
+    INDEX_MAINTENANCE_WORK_MEM = '1GB'
+
+    def __init__(self, import_base, revision_date, deferred_indexes=False, unlogged=False, contextual_source=None):
         self.amplicon_code_names = {}  # mapping from dirname to amplicon ontology
-        self._engine = make_engine()
+        engine_args = {}
+        if unlogged:
+            # an import which fails is re-run from scratch, so there's no need
+            # to wait for commits to be flushed either
+            engine_args['connect_args'] = {'options': '-c synchronous_commit=off'}
+        # bulk inserts are sent as multi-row INSERT .. VALUES statements
+        self._engine = make_engine(executemany_mode='values', **engine_args)
         self._create_extensions()
         self._session = sessionmaker(bind=self._engine)()
         self._import_base = import_base
         self._revision_date = revision_date
+        self._deferred_indexes = deferred_indexes
+        self._unlogged = unlogged
+        # a JSON file of contextual metadata rows, used in place of the AM
+        # contextual metadata (e.g. for synthetic data)
+        self._contextual_source = contextual_source
+        self._progress = ImportProgress()
+        self._otu_lookup = None
+        # identifies this import: cached data (query results, exports, BLAST
+        # databases) is keyed on it
+        self._uuid = str(uuid.uuid4())
 
         # these are used exclusively for reporting back to CSIRO on the state of the ingest
         self.sample_metadata_incomplete = set()
@@ -96,15 +193,128 @@ class DataImporter:
             self._session.invalidate()
         self._session.execute(CreateSchema(SCHEMA))
         self._session.commit()
-        Base.metadata.create_all(self._engine)
+        self._create_tables()
         self.ontology_init()
 
+    @property
+    def progress(self):
+        return self._progress
+
+    def stages(self):
+        "the stages of the import, in order: (name, input file paths, function)"
+        stages = [
+            ('contextual metadata', [], self.load_contextual_metadata),
+            ('taxonomy', self.amplicon_file_paths('*.taxonomy.gz'), self._load_taxonomies),
+            ('abundance', self.amplicon_file_paths('*.txt.gz'), self._load_otu_abundance),
+            ('abundance rollups', [], self.build_abundance_rollups),
+        ]
+        if self._deferred_indexes:
+            stages.append(('indexes', [], self.build_deferred_indexes))
+        stages += [
+            ('BLAST databases', [], self.build_blast_databases),
+            ('k-mer index', [], self.build_kmer_index),
+        ]
+        if self._unlogged:
+            stages.append(('set logged', [], self.set_logged))
+        return stages
+
+    def run_stage(self, name, paths, fn):
+        with self._progress.stage(name, paths):
+            fn()
+
     def run(self):
-        self.load_contextual_metadata()
-        otu_lookup = self.load_taxonomies()
-        self.load_otu_abundance(otu_lookup)
+        for stage in self.stages():
+            self.run_stage(*stage)
         self.complete()
 
+    def _load_taxonomies(self):
+        self._otu_lookup = self.load_taxonomies()
+
+    def _load_otu_abundance(self):
+        self.load_otu_abundance(self._otu_lookup)
+        # no longer needed
+        self._otu_lookup = None
+
+    def _bulk_tables(self):
+        "the bulk loaded tables, referenced tables first"
+        bulk = [db_class.__table__ for db_class in self.BULK_TABLES]
+        return [table for table in Base.metadata.sorted_tables if table in bulk]
+
+    def _create_tables(self):
+        if not self._deferred_indexes:
+            Base.metadata.create_all(self._engine)
+        else:
+            deferred = self._bulk_tables()
+            Base.metadata.create_all(
+                self._engine, tables=[t for t in Base.metadata.sorted_tables if t not in deferred])
+            for table in deferred:
+                self._engine.execute(CreateTable(table, include_foreign_key_constraints=[]))
+        if self._unlogged:
+            # a logged table may not reference an unlogged one
+            self._set_bulk_tables_persistence('UNLOGGED', reversed(self._bulk_tables()))
+
+    def _set_bulk_tables_persistence(self, persistence, tables):
+        preparer = self._engine.dialect.identifier_preparer
+        for table in tables:
+            self._engine.execute(
+                text('ALTER TABLE {} SET {}'.format(preparer.format_table(table), persistence))
+                .execution_options(autocommit=True))
+
+    def set_logged(self):
+        # the tables (and their indexes) are written to the WAL in full, once
+        logger.warning('Setting bulk loaded tables to logged')
+        self._set_bulk_tables_persistence('LOGGED', self._bulk_tables())
+
+    def _execute_in_parallel(self, statement_groups):
+        """
+        run each group of statements, in order, on its own connection; the
+        groups are run in parallel
+        """
+        def _run(statements):
+            with self._engine.connect() as conn:
+                conn.execute(text("SET maintenance_work_mem = '{}'".format(self.INDEX_MAINTENANCE_WORK_MEM)))
+                for statement in statements:
+                    logger.info(statement)
+                    conn.execution_options(autocommit=True).execute(text(statement))
+
+        with ThreadPoolExecutor(max_workers=self.INDEX_BUILD_CONCURRENCY) as executor:
+            for future in [executor.submit(_run, statements) for statements in statement_groups]:
+                future.result()
+
+    def build_deferred_indexes(self):
+        dialect = self._engine.dialect
+        deferred = self._bulk_tables()
+
+        logger.warning('Building indexes')
+        # CREATE INDEX only blocks writes, so indexes on the same table can be built at once
+        self._execute_in_parallel(
+            [str(CreateIndex(index).compile(dialect=dialect))]
+            for table in deferred for index in sorted(table.indexes, key=lambda index: index.name))
+
+        logger.warning('Adding foreign keys')
+        # added NOT VALID, so no check is made while the table is locked, then
+        # validated; validation doesn't block reads or writes, but only one
+        # constraint of a table may be validated at a time
+        preparer = dialect.identifier_preparer
+        add_statements = []
+        validate_statements = []
+        for table in deferred:
+            table_name = preparer.format_table(table)
+            validate = []
+            for fk in sorted(table.foreign_key_constraints, key=lambda fk: fk.column_keys):
+                # the name postgres would have given the constraint
+                name = preparer.quote('{}_{}_fkey'.format(table.name, '_'.join(fk.column_keys)))
+                add_statements.append(
+                    'ALTER TABLE {} ADD CONSTRAINT {} FOREIGN KEY ({}) REFERENCES {} ({}) NOT VALID'.format(
+                        table_name, name,
+                        ', '.join(preparer.quote(element.parent.name) for element in fk.elements),
+                        preparer.format_table(fk.referred_table),
+                        ', '.join(preparer.quote(element.column.name) for element in fk.elements)))
+                validate.append('ALTER TABLE {} VALIDATE CONSTRAINT {}'.format(table_name, name))
+            validate_statements.append(validate)
+        self._execute_in_parallel([add_statements])
+        self._execute_in_parallel(validate_statements)
+
     def ontology_init(self):
         # set blank as an option for all ontologies, bar Environment
         all_cls = set(
@@ -138,7 +348,9 @@ class DataImporter:
             methodology='v1',
             revision_date=datetime.datetime.strptime(self._revision_date, "%Y-%m-%d").date(),
             imported_at=datetime.date.today(),
-            uuid=str(uuid.uuid4()),
+            uuid=self._uuid,
+            elapsed=self._progress.elapsed(),
+            stage_timings=self._progress.summary(),
             sampleotu_count=self._session.query(SampleOTU).count(),
             samplecontext_count=self._session.query(SampleContext).count(),
             otu_count=self._session.query(OTU).count()))
@@ -168,9 +380,11 @@ class DataImporter:
         self._session.commit()
         return dict((t.value, t.id) for t in self._session.query(db_class).all())
 
-    def _load_ontology(self, ontology_defn, row_iter, key_set=set()):
+    def _load_ontology(self, ontology_defn, row_iter, key_set=None):
         # import the ontologies, and build a mapping from
         # permitted values into IDs in those ontologies
+        if key_set is None:
+            key_set = set()
         by_class = defaultdict(list)
         for field, db_class in ontology_defn.items():
             by_class[db_class].append(field)
@@ -226,6 +440,9 @@ class DataImporter:
             amplicon = fname.split('/')[-2]
             yield amplicon, fname
 
+    def amplicon_file_paths(self, pattern):
+        return [fname for _, fname in self.amplicon_files(pattern)]
+
     def make_file_log(self, filename, **attrs):
         attrs['file_size'] = os.stat(filename).st_size
         attrs['filename'] = os.path.basename(filename)
@@ -235,9 +452,8 @@ class DataImporter:
         self._session.commit()
 
     def load_taxonomies(self):
-        # md5(otu code) -> otu ID, returned
-
-        otu_lookup = {}
+        # (amplicon, otu code) -> otu ID, returned
+        otu_lookup = OTULookup()
         taxonomy_fields = [
             'id', 'code',
             # order here must match `ontologies' below
@@ -261,7 +477,8 @@ class DataImporter:
             for amplicon_code, fname in self.amplicon_files('*.taxonomy.gz'):
                 logger.warning('reading taxonomy file: {}'.format(fname))
                 amplicon = None
-                with gzip.open(fname, 'rt') as fd:
+                with self._progress.file(fname) as file_progress, open_gzip(fname, 'rt') as fd:
+                    file_progress.watch(fd)
                     reader = csv.reader(fd, dialect='excel-tab')
                     header = next(reader)
                     assert(header[0] == otu_header)
@@ -282,17 +499,25 @@ class DataImporter:
                                 'more than one amplicon in folder: {} vs {}'.format(amplicon, obj['amplicon']))
                         obj.update(zip(taxo_header, row[1:-1]))
                         yield obj
+                        if idx % self.PROGRESS_ROWS == 0:
+                            file_progress.update(idx)
+                    file_progress.update(idx + 1)
                 self.amplicon_code_names[amplicon_code.lower()] = amplicon
                 taxonomy_file_info[fname] = {
                     'file_type': 'Taxonomy',
                     'rows_imported': idx + 1,
-                    'rows_skipped': 0
+                    'rows_skipped': 0,
                 }
+                taxonomy_file_info[fname].update(file_progress.attrs())
 
-        logger.warning("loading taxonomies - pass 1, defining ontologies")
-        mappings = self._load_ontology(ontologies, _taxon_rows_iter())
+        # single pass: ontology IDs are assigned as values are first seen,
+        # and the ontologies written out before the OTUs which reference them
+        mappings = OrderedDict((field, {}) for field in ontologies)
+        next_ids = dict((field, count(1)) for field in ontologies)
+        # defined at import init
+        mappings['species'][''] = 0
 
-        logger.warning("loading taxonomies - pass 2, defining OTUs")
+        logger.warning("loading taxonomies")
         try:
             with tempfile.NamedTemporaryFile(mode='w', dir='/data', prefix='bpaotu-', delete=False) as temp_fd:
                 fname = temp_fd.name
@@ -301,25 +526,44 @@ class DataImporter:
                 w = csv.writer(temp_fd)
                 w.writerow(taxonomy_fields)
                 for _id, row in enumerate(_taxon_rows_iter(), 1):
-                    otu_key = otu_hash(row['otu'], row['amplicon'])
-                    assert(otu_key not in otu_lookup)
-                    otu_lookup[otu_key] = _id
+                    otu_lookup.add(row['amplicon'], row['otu'], _id)
 
                     otu_row = [_id, row['otu']]
-                    for field in ontologies:
+                    for field, mapping in mappings.items():
                         val = row.get(field, '')
-                        otu_row.append(mappings[field][val])
+                        val_id = mapping.get(val)
+                        if val_id is None:
+                            val_id = mapping[val] = next(next_ids[field])
+                        otu_row.append(val_id)
                     w.writerow(otu_row)
+            self._write_taxonomy_ontologies(ontologies, mappings)
             logger.warning("loading taxonomy data from temporary CSV file")
             self._engine.execute(
                 text('''COPY otu.otu from :csv CSV header''').execution_options(autocommit=True),
                 csv=fname)
         finally:
             os.unlink(fname)
+        otu_lookup.finalize()
         for fname, info in taxonomy_file_info.items():
             self.make_file_log(fname, **info)
         return otu_lookup
 
+    def _write_taxonomy_ontologies(self, ontologies, mappings):
+        for field, db_class in ontologies.items():
+            if not mappings[field]:
+                raise ImportException("empty ontology: {}".format(db_class))
+            # the blank option, defined at import init, is already present
+            rows = [{'id': val_id, 'value': val} for val, val_id in mappings[field].items() if val_id != 0]
+            if not rows:
+                continue
+            self._session.bulk_insert_mappings(db_class, rows)
+            # IDs were assigned here, not by the database
+            table = db_class.__table__
+            self._session.execute(
+                text("SELECT setval(pg_get_serial_sequence(:table, 'id'), :max_id)"),
+                {'table': '{}.{}'.format(table.schema, table.name), 'max_id': max(row['id'] for row in rows)})
+        self._session.commit()
+
     def save_ontology_errors(self, environment_ontology_errors):
         if environment_ontology_errors is None:
             return
@@ -341,13 +585,20 @@ class DataImporter:
                 for sample_id in contextual_source.sample_ids():
                     metadata[sample_id]['sample_id'] = sample_id
                     metadata[sample_id].update(contextual_source.get(sample_id))
+        return self._complete_contextual_rows(metadata.values())
+
+    def contextual_rows_from_file(self, path):
+        # a JSON list of flattened contextual metadata dicts, as `contextual_rows'
+        with open_gzip(path, 'rt') if path.endswith('.gz') else open(path) as fd:
+            return self._complete_contextual_rows(json.load(fd))
 
+    def _complete_contextual_rows(self, metadata):
         def has_minimum_metadata(row):
             return 'latitude' in row and 'longitude' in row \
                 and isinstance(row['latitude'], float) and isinstance(row['longitude'], float)
 
         rows = []
-        for entry in metadata.values():
+        for entry in metadata:
             if not has_minimum_metadata(entry):
                 self.sample_metadata_incomplete.add(
                     int(entry['sample_id'].split('/')[-1]))
@@ -372,7 +623,7 @@ class DataImporter:
                     continue
                 attrs[field] = value
             fields_used.update(set(attrs.keys()))
-            yield SampleContext(**attrs)
+            yield attrs
 
     def load_contextual_metadata(self):
         # we have a bit of a broken window in the SampleContext class, so we
@@ -380,11 +631,23 @@ class DataImporter:
         # updating the code for new versions of the source spreadsheet
         utilised_fields = set()
         logger.warning("loading Soil contextual metadata")
-        metadata = self.contextual_rows(AccessAMDContextualMetadata, name='amd-metadata')
+        if self._contextual_source is not None:
+            metadata = self.contextual_rows_from_file(self._contextual_source)
+        else:
+            metadata = self.contextual_rows(AccessAMDContextualMetadata, name='amd-metadata')
         mappings = self._load_ontology(DataImporter.amd_ontologies, metadata)
-        for obj in self.contextual_row_context(metadata, DataImporter.amd_ontologies, mappings, utilised_fields):
-            self._session.add(obj)
-            self._session.commit()
+        rows = list(self.contextual_row_context(metadata, DataImporter.amd_ontologies, mappings, utilised_fields))
+        self._progress.add_rows(len(rows))
+        # every row must have the same keys, or the bulk insert is split into
+        # a statement per distinct key set
+        defaults = {}
+        for field in utilised_fields:
+            column = SampleContext.__table__.columns[field]
+            defaults[field] = column.default.arg if column.default is not None else None
+        for batch in grouper(rows, self.CONTEXTUAL_BATCH_SIZE):
+            self._session.bulk_insert_mappings(
+                SampleContext, [dict(defaults, **attrs) for attrs in batch if attrs is not None],
+                render_nulls=True)
         self._session.commit()
         unused = set(t.name for t in SampleContext.__table__.columns) - utilised_fields
         if unused:
@@ -392,66 +655,133 @@ class DataImporter:
             for field in sorted(unused):
                 logger.info(field)
 
-    def _otu_abundance_rows(self, fd, amplicon_code, otu_lookup):
-        reader = csv.reader(fd, dialect='excel-tab')
-        header = next(reader)
-
-        assert(header == ["#OTU ID", "Sample_only", "Abundance"])
-        integer_re = re.compile(r'^[0-9]+$')
-
-        for otu_code, sample_id, count in reader:
-            float_count = float(count)
-            int_count = int(float_count)
+    def _otu_abundance_chunks(self, fname, amplicon_code, otu_lookup, present_sample_ids, stats, file_progress):
+        """
+        parse an abundance table in chunks, yielding a DataFrame of (sample_id,
+        otu_id, count) for each. validation and the OTU lookup are done a column
+        at a time.
+        """
+        amplicon = self.amplicon_code_names[amplicon_code.lower()]
+        with open_gzip(fname) as fd:
+            file_progress.watch(fd)
+            header = fd.readline().decode('utf8').rstrip('\r\n').split('\t')
+            assert(header == ["#OTU ID", "Sample_only", "Abundance"])
+            reader = pd.read_csv(
+                fd, sep='\t', header=None,
+                names=['otu', 'sample_id', 'count'], dtype={'otu': str, 'sample_id': str, 'count': np.float64},
+                na_filter=False, quoting=csv.QUOTE_NONE, chunksize=self.ABUNDANCE_CHUNK_SIZE)
+            yield from self._otu_abundance_frames(
+                reader, amplicon, amplicon_code, otu_lookup, present_sample_ids, stats, file_progress)
+
+    def _otu_abundance_frames(self, reader, amplicon, amplicon_code, otu_lookup, present_sample_ids, stats,
+                              file_progress):
+        rows_read = 0
+        for chunk in reader:
+            float_counts = chunk['count'].values
+            counts = float_counts.astype(np.int64)
             # make sure that fractional values don't creep in on a future ingest
-            assert(int_count - float_count == 0)
-            if not integer_re.match(sample_id):
-                if sample_id not in self.sample_non_integer:
+            assert((counts == float_counts).all())
+
+            sample_id_strs = chunk['sample_id']
+            is_integer = sample_id_strs.str.match(r'^[0-9]+$').values
+            if not is_integer.all():
+                for sample_id in set(sample_id_strs.values[~is_integer]) - self.sample_non_integer:
                     logger.warning('[{}] skipped non-integer sample ID: {}'.format(amplicon_code, sample_id))
                     self.sample_non_integer.add(sample_id)
-                continue
-            sample_id_int = int(sample_id)
-            otu_id = otu_lookup[otu_hash(otu_code, self.amplicon_code_names[amplicon_code.lower()])]
-            yield otu_id, sample_id_int, int_count
+            sample_ids = sample_id_strs.values[is_integer].astype(np.int64)
+
+            in_metadata = np.isin(sample_ids, present_sample_ids)
+            if not in_metadata.all():
+                self.sample_not_in_metadata.update(
+                    set(sample_ids[~in_metadata].tolist()) - self.sample_metadata_incomplete)
+
+            keep = np.flatnonzero(is_integer)[in_metadata]
+            stats['rows_imported'] += len(keep)
+            stats['rows_skipped'] += len(chunk) - len(keep)
+            rows_read += len(chunk)
+            file_progress.update(rows_read)
+            yield pd.DataFrame({
+                'sample_id': sample_ids[in_metadata],
+                'otu_id': otu_lookup.lookup(amplicon, chunk['otu'].values[keep]),
+                'count': counts[keep],
+            })
 
     def load_otu_abundance(self, otu_lookup):
-        def _make_sample_otus(fname, amplicon_code, present_sample_ids):
-            with gzip.open(fname, 'rt') as fd:
-                tuple_rows = self._otu_abundance_rows(fd, amplicon_code, otu_lookup)
-                rows_skipped = 0
-                for entry, (otu_id, sample_id, count) in enumerate(tuple_rows):
-                    if sample_id not in present_sample_ids:
-                        if sample_id not in self.sample_metadata_incomplete \
-                                and sample_id not in self.sample_non_integer:
-                            self.sample_not_in_metadata.add(sample_id)
-                        rows_skipped += 1
-                        continue
-                    yield (sample_id, otu_id, count)
-                self.make_file_log(
-                    fname, file_type='Abundance', rows_imported=entry, rows_skipped=rows_skipped)
-
         logger.warning('Loading OTU abundance tables')
 
-        present_sample_ids = set([t[0] for t in self._session.query(SampleContext.id)])
+        present_sample_ids = np.array([t[0] for t in self._session.query(SampleContext.id)], dtype=np.int64)
 
         for amplicon_code, sampleotu_fname in self.amplicon_files('*.txt.gz'):
             def log_amplicon(msg):
                 logger.warning('[{}] {}'.format(amplicon_code, msg))
+            log_amplicon("reading from: {}".format(sampleotu_fname))
+            stats = {'rows_imported': 0, 'rows_skipped': 0}
+            # each chunk is streamed into the database as it is parsed; the file
+            # is loaded in a single transaction
+            conn = self._engine.raw_connection()
             try:
-                log_amplicon("reading from: {}".format(sampleotu_fname))
-                with tempfile.NamedTemporaryFile(mode='w', dir='/data', prefix='bpaotu-', delete=False) as temp_fd:
-                    fname = temp_fd.name
-                    os.chmod(fname, 0o644)
-                    log_amplicon("writing out OTU abundance data to CSV tempfile: {}".format(fname))
-                    w = csv.writer(temp_fd)
-                    w.writerow(['sample_id', 'otu_id', 'count'])
-                    w.writerows(_make_sample_otus(sampleotu_fname, amplicon_code, present_sample_ids))
-                log_amplicon("loading OTU abundance data into database")
-                try:
-                    self._engine.execute(
-                        text('''COPY otu.sample_otu from :csv CSV header''').execution_options(autocommit=True),
-                        csv=fname)
-                except:  # noqa
-                    log_amplicon("unable to import {}".format(sampleotu_fname))
-                    traceback.print_exc()
+                with self._progress.file(sampleotu_fname) as file_progress, conn.cursor() as cursor:
+                    # parse and validation errors abort the import; only a
+                    # failure to load the file is skipped
+                    try:
+                        for chunk in self._otu_abundance_chunks(
+                                sampleotu_fname, amplicon_code, otu_lookup, present_sample_ids, stats,
+                                file_progress):
+                            buf = io.StringIO()
+                            chunk.to_csv(buf, header=False, index=False)
+                            nbytes = buf.tell()
+                            buf.seek(0)
+                            copy_started = time.time()
+                            cursor.copy_expert('COPY otu.sample_otu (sample_id, otu_id, count) FROM STDIN CSV', buf)
+                            file_progress.copied(nbytes, time.time() - copy_started)
+                        conn.commit()
+                    except psycopg2.Error:
+                        conn.rollback()
+                        log_amplicon("unable to import {}".format(sampleotu_fname))
+                        traceback.print_exc()
+                        # nothing from the file was loaded
+                        stats['rows_skipped'] += stats['rows_imported']
+                        stats['rows_imported'] = 0
             finally:
-                os.unlink(fname)
+                conn.close()
+            log_amplicon("loaded {rows_imported} rows, skipped {rows_skipped}".format(**stats))
+            self.make_file_log(sampleotu_fname, file_type='Abundance', **stats, **file_progress.attrs())
+
+    def build_blast_databases(self):
+        logger.warning('Building BLAST databases')
+        build_databases(self._session, self._uuid)
+
+    def build_kmer_index(self):
+        logger.warning('Building OTU k-mer index')
+        build_index(self._session, self._uuid)
+
+    def build_abundance_rollups(self):
+        """
+        per-sample totals, and per-sample counts rolled up by taxonomy, used to
+        map abundance without aggregating over SampleOTU at query time
+        """
+        taxonomy_columns = [
+            OTU.kingdom_id, OTU.phylum_id, OTU.class_id, OTU.order_id,
+            OTU.family_id, OTU.genus_id, OTU.species_id, OTU.amplicon_id]
+
+        logger.warning('Building per-sample OTU count totals')
+        q = self._session.query(
+            SampleOTU.sample_id,
+            OTU.amplicon_id,
+            sqlalchemy.func.sum(SampleOTU.count)) \
+            .join(OTU, OTU.id == SampleOTU.otu_id) \
+            .group_by(SampleOTU.sample_id, OTU.amplicon_id)
+        self._engine.execute(
+            SampleAmpliconCount.__table__.insert().from_select(
+                ['sample_id', 'amplicon_id', 'count'], q.statement))
+
+        logger.warning('Building per-sample OTU count rollup by taxonomy')
+        q = self._session.query(
+            SampleOTU.sample_id,
+            *taxonomy_columns,
+            sqlalchemy.func.sum(SampleOTU.count)) \
+            .join(OTU, OTU.id == SampleOTU.otu_id) \
+            .group_by(SampleOTU.sample_id, *taxonomy_columns)
+        self._engine.execute(
+            SampleTaxonCount.__table__.insert().from_select(
+                ['sample_id'] + [c.name for c in taxonomy_columns] + ['count'], q.statement))
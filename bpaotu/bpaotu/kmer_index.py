@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+import shutil
+from glob import glob
+
+import numpy as np
+from django.conf import settings
+from numpy.lib.stride_tricks import as_strided
+
+from .otu import OTU
+from .query import SampleQuery
+
+logger = logging.getLogger("rainbow")
+
+
+# minimizer sketch of each OTU code: of each window of WINDOW consecutive
+# k-mers (of length K), the k-mer with the smallest hash is kept. OTUs sharing
+# many minimizers with a query sequence are candidate matches.
+K = 15
+WINDOW = 10
+# minimizers occurring in more OTUs than this carry little information, and
+# are skipped at search time
+MAX_OCCURRENCES = 50000
+BUILD_BATCH_SIZE = 10000
+# candidates are drawn from the index in excess of the number of results
+# requested, as some will be removed by the query's filters
+CANDIDATE_FACTOR = 10
+
+HASHES_FILE = 'hashes.npy'
+OTU_IDS_FILE = 'otu_ids.npy'
+INFO_FILE = 'index.json'
+
+# 2-bit encoding of nucleotides; anything else (e.g. N) is invalid
+INVALID = 255
+_ENCODE = np.full(256, INVALID, dtype=np.uint8)
+for _idx, _base in enumerate('ACGT'):
+    _ENCODE[ord(_base)] = _ENCODE[ord(_base.lower())] = _idx
+
+_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+class KmerIndexError(Exception):
+    pass
+
+
+def _hash(values):
+    # multiplicative hash with an xor-shift, so minimizers aren't biased
+    # towards poly-A runs
+    with np.errstate(over='ignore'):
+        h = values * _HASH_MULTIPLIER
+    return h ^ (h >> np.uint64(29))
+
+
+def _windows(arr, width):
+    "a read-only (len(arr) - width + 1, width) view of the sliding windows over `arr`"
+    stride = arr.strides[0]
+    return as_strided(arr, shape=(len(arr) - width + 1, width), strides=(stride, stride), writeable=False)
+
+
+def kmer_hashes(sequence, k=K):
+    """
+    the hashes of each k-mer in `sequence` (a str), in order. k-mers containing
+    anything other than A, C, G, T are skipped.
+    """
+    codes = _ENCODE[np.frombuffer(sequence.encode('ascii', 'replace'), dtype=np.uint8)]
+    if len(codes) < k:
+        return np.empty(0, dtype=np.uint64)
+    windows = _windows(codes, k)
+    valid = (windows != INVALID).all(axis=1)
+    values = np.zeros(len(windows), dtype=np.uint64)
+    for i in range(k):
+        values = (values << np.uint64(2)) | windows[:, i].astype(np.uint64)
+    return _hash(values[valid])
+
+
+def minimizers(sequence, k=K, window=WINDOW):
+    "the distinct minimizer hashes of `sequence`, sorted"
+    hashes = kmer_hashes(sequence, k)
+    if len(hashes) == 0:
+        return hashes
+    if len(hashes) <= window:
+        return np.unique(hashes.min(keepdims=True))
+    return np.unique(_windows(hashes, window).min(axis=1))
+
+
+def index_dir(import_uuid):
+    return os.path.join(settings.KMER_INDEX_PATH, import_uuid)
+
+
+def build_index(session, import_uuid):
+    """
+    build the index of all OTU codes: an array of minimizer hashes, sorted, and
+    a parallel array of the ID of the OTU each occurs in. written as .npy files,
+    so they may be memory-mapped.
+    """
+    hash_arrays = []
+    otu_id_arrays = []
+    q = session.query(OTU.id, OTU.code).order_by(OTU.id)
+    for otu_id, code in q.yield_per(BUILD_BATCH_SIZE):
+        otu_minimizers = minimizers(code)
+        hash_arrays.append(otu_minimizers)
+        otu_id_arrays.append(np.full(len(otu_minimizers), otu_id, dtype=np.int32))
+    hashes = np.concatenate(hash_arrays) if hash_arrays else np.empty(0, dtype=np.uint64)
+    otu_ids = np.concatenate(otu_id_arrays) if otu_id_arrays else np.empty(0, dtype=np.int32)
+    del hash_arrays, otu_id_arrays
+
+    order = np.argsort(hashes, kind='mergesort')
+    target_dir = index_dir(import_uuid)
+    os.makedirs(target_dir, exist_ok=True)
+    np.save(os.path.join(target_dir, HASHES_FILE), hashes[order])
+    np.save(os.path.join(target_dir, OTU_IDS_FILE), otu_ids[order])
+    # written last: marks the index as complete
+    with open(os.path.join(target_dir, INFO_FILE), 'w') as fd:
+        json.dump({'k': K, 'window': WINDOW, 'entries': len(hashes)}, fd)
+    logger.warning('k-mer index built: {} minimizers'.format(len(hashes)))
+
+    for path in glob(os.path.join(settings.KMER_INDEX_PATH, '*')):
+        if path != target_dir and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+class KmerIndex:
+    """
+    the k-mer index of an import, memory-mapped: each process maps the same
+    files, so the page cache holds one copy shared by all uWSGI workers.
+    """
+
+    def __init__(self, import_uuid):
+        target_dir = index_dir(import_uuid)
+        try:
+            with open(os.path.join(target_dir, INFO_FILE)) as fd:
+                info = json.load(fd)
+        except FileNotFoundError:
+            raise KmerIndexError('Sequence index is not available')
+        self.k = info['k']
+        self.window = info['window']
+        self._hashes = np.load(os.path.join(target_dir, HASHES_FILE), mmap_mode='r')
+        self._otu_ids = np.load(os.path.join(target_dir, OTU_IDS_FILE), mmap_mode='r')
+
+    def search(self, sequence, limit):
+        """
+        returns (number of minimizers in `sequence`, [(otu_id, shared_minimizers), ...]),
+        the OTUs sharing the most minimizers with `sequence`, best first.
+        """
+        query = minimizers(sequence, self.k, self.window)
+        if len(query) == 0:
+            return 0, []
+        left = np.searchsorted(self._hashes, query, side='left')
+        right = np.searchsorted(self._hashes, query, side='right')
+        slices = [
+            self._otu_ids[lo:hi] for lo, hi in zip(left, right)
+            if 0 < hi - lo <= MAX_OCCURRENCES]
+        if not slices:
+            return len(query), []
+        otu_ids, counts = np.unique(np.concatenate(slices), return_counts=True)
+        best = np.argsort(-counts, kind='mergesort')[:limit]
+        return len(query), [(int(otu_ids[i]), int(counts[i])) for i in best]
+
+
+_indexes = {}
+
+
+def get_index(import_uuid):
+    index = _indexes.get(import_uuid)
+    if index is None:
+        index = _indexes[import_uuid] = KmerIndex(import_uuid)
+    return index
+
+
+def sequence_search(params, import_uuid, sequence, limit):
+    """
+    the OTUs matching `params` which are most similar to `sequence`, by the
+    number of minimizers they share with it. as these are candidates only,
+    a BLAST search may be used to verify them.
+    """
+    query_size, candidates = get_index(import_uuid).search(sequence, limit * CANDIDATE_FACTOR)
+    if not candidates:
+        return []
+    shared = dict(candidates)
+    with SampleQuery(params) as query:
+        q = query.matching_otus().filter(OTU.id.in_(shared.keys()))
+        otus = q.all()
+    otus.sort(key=lambda otu: (-shared[otu.id], otu.id))
+    return [{
+        'otu_id': otu.id,
+        'code': otu.code,
+        'amplicon_id': otu.amplicon_id,
+        'shared_minimizers': shared[otu.id],
+        'score': shared[otu.id] / query_size,
+    } for otu in otus[:limit]]
@@ -0,0 +1,22 @@
+import asyncio
+import signal
+
+from django.core.management.base import BaseCommand
+from ...upload_watcher import UploadWatcher
+
+
+class Command(BaseCommand):
+    help = 'Watch pending Galaxy uploads, recording their state as they finish'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=None)
+
+    async def watch(self, watcher):
+        loop = asyncio.get_event_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, watcher.stop)
+        await watcher.run()
+
+    def handle(self, *args, **kwargs):
+        watcher = UploadWatcher(concurrency=kwargs['concurrency'])
+        asyncio.run(self.watch(watcher))
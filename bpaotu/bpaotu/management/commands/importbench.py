@@ -0,0 +1,102 @@
+import datetime
+import os
+import resource
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...importer import DataImporter
+
+#
+# Runs the importer stage by stage, reporting the time taken and peak memory
+# use of each, so that importer performance may be tracked longitudinally.
+# Use with a dataset from otu_synthetic. NB: this replaces the OTU schema of
+# the configured database.
+#
+
+# stages which build search indexes, rather than load data
+SEARCH_INDEX_STAGES = ('BLAST databases', 'k-mer index')
+
+
+class RSSSampler:
+    "samples the resident set size of this process, tracking the peak"
+
+    def __init__(self, interval=0.1):
+        self._interval = interval
+        self._page_size = os.sysconf('SC_PAGE_SIZE')
+        self._stopping = threading.Event()
+        self.peak = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def rss(self):
+        with open('/proc/self/statm') as fd:
+            return int(fd.read().split()[1]) * self._page_size
+
+    def _run(self):
+        while not self._stopping.wait(self._interval):
+            self.peak = max(self.peak, self.rss())
+
+    def reset(self):
+        self.peak = self.rss()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+
+
+class Command(BaseCommand):
+    help = 'benchmark the importer, stage by stage'
+
+    def add_arguments(self, parser):
+        parser.add_argument('base_dir', type=str)
+        parser.add_argument(
+            '--contextual-source', type=str,
+            help='JSON file of contextual metadata (default: contextual.json.gz in base_dir)')
+        parser.add_argument('--defer-indexes', action='store_true')
+        parser.add_argument('--unlogged', action='store_true')
+        parser.add_argument(
+            '--skip-search-indexes', action='store_true', help='skip building the BLAST databases and k-mer index')
+        parser.add_argument(
+            '--force', action='store_true', help='required: the OTU schema of the database is replaced')
+
+    def handle(self, *args, **kwargs):
+        if not kwargs['force']:
+            raise CommandError('importbench replaces the OTU schema of the configured database: pass --force')
+        contextual_source = kwargs['contextual_source'] or os.path.join(kwargs['base_dir'], 'contextual.json.gz')
+
+        sampler = RSSSampler()
+        results = []
+
+        def measure(name, fn):
+            sampler.reset()
+            started = time.time()
+            result = fn()
+            results.append((name, time.time() - started, sampler.peak))
+            return result
+
+        try:
+            importer = measure('setup', lambda: DataImporter(
+                kwargs['base_dir'], datetime.date.today().strftime('%Y-%m-%d'),
+                deferred_indexes=kwargs['defer_indexes'], unlogged=kwargs['unlogged'],
+                contextual_source=contextual_source))
+            for name, paths, fn in importer.stages():
+                if kwargs['skip_search_indexes'] and name in SEARCH_INDEX_STAGES:
+                    continue
+                measure(name, lambda: importer.run_stage(name, paths, fn))
+            measure('complete', importer.complete)
+        finally:
+            sampler.stop()
+
+        stage_summary = importer.progress.summary()
+        self.stdout.write('{:<24} {:>10} {:>12} {:>12} {:>14}'.format(
+            'stage', 'seconds', 'rows', 'rows/s', 'peak RSS (MB)'))
+        for name, elapsed, peak in results:
+            rows = stage_summary.get(name, {}).get('rows', 0)
+            self.stdout.write('{:<24} {:>10.1f} {:>12,} {:>12,.0f} {:>14.1f}'.format(
+                name, elapsed, rows, rows / elapsed if elapsed > 0 else 0, peak / 1e6))
+        self.stdout.write('total: {:.1f}s, peak RSS {:.1f} MB'.format(
+            sum(elapsed for _, elapsed, _ in results),
+            # kilobytes, on linux
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3))
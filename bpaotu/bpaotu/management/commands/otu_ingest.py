@@ -1,4 +1,3 @@
-
 from django.core.management.base import BaseCommand
 from ...importer import DataImporter
 
@@ -7,7 +6,18 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('base_dir', type=str)
         parser.add_argument('revision_date', type=str)
+        parser.add_argument(
+            '--defer-indexes', action='store_true',
+            help='create indexes and foreign keys on the OTU and abundance tables after loading them')
+        parser.add_argument(
+            '--unlogged', action='store_true',
+            help='load the OTU and abundance tables without write-ahead logging, set logged once complete')
+        parser.add_argument(
+            '--contextual-source', type=str,
+            help='JSON file of contextual metadata to load, in place of the AM contextual metadata')
 
     def handle(self, *args, **kwargs):
-        importer = DataImporter(kwargs['base_dir'], kwargs['revision_date'])
+        importer = DataImporter(
+            kwargs['base_dir'], kwargs['revision_date'], deferred_indexes=kwargs['defer_indexes'],
+            unlogged=kwargs['unlogged'], contextual_source=kwargs['contextual_source'])
         importer.run()
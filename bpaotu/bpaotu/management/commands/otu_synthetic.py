@@ -0,0 +1,101 @@
+import csv
+import gzip
+import json
+import os
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+# Generates a synthetic dataset in the layout read by the importer, so that
+# importer performance may be measured without production data:
+#
+# <out_dir>/<amplicon>/<amplicon>.taxonomy.gz
+# <out_dir>/<amplicon>/<amplicon>.txt.gz
+# <out_dir>/contextual.json.gz  (stand-in for the AM contextual metadata;
+#                                see otu_ingest --contextual-source)
+
+TAXONOMY_LEVELS = ['kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species']
+# number of distinct values at each taxonomic level
+TAXONOMY_VALUES = [4, 40, 120, 300, 800, 2000, 5000]
+CODE_LENGTH = 250
+# abundance rows are generated for this many (sample, OTU) pairs at a time
+BATCH_CELLS = 10 ** 7
+
+
+class Command(BaseCommand):
+    help = 'generate a synthetic dataset for importer benchmarks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('out_dir', type=str)
+        parser.add_argument('--amplicons', type=int, default=2, help='number of amplicons')
+        parser.add_argument('--otus', type=int, default=100000, help='OTUs per amplicon')
+        parser.add_argument('--samples', type=int, default=1000, help='number of samples')
+        parser.add_argument(
+            '--density', type=float, default=0.01,
+            help='fraction of (sample, OTU) pairs with a non-zero abundance')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def write_contextual(self, rng, out_dir, sample_ids):
+        rows = []
+        for sample_id in sample_ids:
+            environment = 'Soil' if rng.random_sample() < 0.5 else 'Marine'
+            rows.append({
+                'sample_id': '102.100.100/{}'.format(sample_id),
+                'environment': environment,
+                'sample_type': 'Soil' if environment == 'Soil' else 'Coastal water',
+                'latitude': float(rng.uniform(-44, -10)),
+                'longitude': float(rng.uniform(113, 154)),
+                'depth': float(rng.uniform(0, 100)),
+            })
+        with gzip.open(os.path.join(out_dir, 'contextual.json.gz'), 'wt') as fd:
+            json.dump(rows, fd)
+
+    def make_codes(self, rng, n):
+        bases = np.frombuffer(b'GATC', dtype=np.uint8)
+        codes = bases[rng.randint(0, 4, size=(n, CODE_LENGTH))]
+        return [row.tobytes().decode('ascii') for row in codes]
+
+    def write_taxonomy(self, rng, path, amplicon, codes):
+        with gzip.open(path, 'wt') as fd:
+            writer = csv.writer(fd, dialect='excel-tab')
+            writer.writerow(['#OTU ID'] + TAXONOMY_LEVELS + ['amplicon'])
+            # each level's value is derived from the one below, so the
+            # taxonomy forms a tree
+            leaves = rng.randint(0, TAXONOMY_VALUES[-1], size=len(codes))
+            for code, leaf in zip(codes, leaves):
+                taxonomy = [
+                    '{}_{}'.format(level, leaf * n // TAXONOMY_VALUES[-1])
+                    for level, n in zip(TAXONOMY_LEVELS, TAXONOMY_VALUES)]
+                writer.writerow([code] + taxonomy + [amplicon])
+
+    def write_abundance(self, rng, path, codes, sample_ids, density):
+        sample_ids = np.asarray(sample_ids)
+        rows = 0
+        with gzip.open(path, 'wt') as fd:
+            writer = csv.writer(fd, dialect='excel-tab')
+            writer.writerow(['#OTU ID', 'Sample_only', 'Abundance'])
+            batch_size = max(1, BATCH_CELLS // len(sample_ids))
+            for start in range(0, len(codes), batch_size):
+                batch = codes[start:start + batch_size]
+                present = rng.random_sample((len(batch), len(sample_ids))) < density
+                counts = rng.geometric(0.05, size=present.shape)
+                for otu_idx, sample_idx in zip(*np.nonzero(present)):
+                    writer.writerow([batch[otu_idx], sample_ids[sample_idx], counts[otu_idx, sample_idx]])
+                    rows += 1
+        return rows
+
+    def handle(self, *args, **kwargs):
+        out_dir = kwargs['out_dir']
+        rng = np.random.RandomState(kwargs['seed'])
+        os.makedirs(out_dir, exist_ok=True)
+        sample_ids = list(range(10000, 10000 + kwargs['samples']))
+        self.write_contextual(rng, out_dir, sample_ids)
+        for amplicon_idx in range(kwargs['amplicons']):
+            amplicon = 'amplicon{}'.format(amplicon_idx)
+            amplicon_dir = os.path.join(out_dir, amplicon)
+            os.makedirs(amplicon_dir, exist_ok=True)
+            codes = self.make_codes(rng, kwargs['otus'])
+            self.write_taxonomy(rng, os.path.join(amplicon_dir, amplicon + '.taxonomy.gz'), amplicon, codes)
+            rows = self.write_abundance(
+                rng, os.path.join(amplicon_dir, amplicon + '.txt.gz'), codes, sample_ids, kwargs['density'])
+            self.stdout.write('{}: {} OTUs, {} abundance rows'.format(amplicon, len(codes), rows))
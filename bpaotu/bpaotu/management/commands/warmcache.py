@@ -2,6 +2,7 @@
 from django.core.management.base import BaseCommand
 from ...query import TaxonomyOptions, OntologyInfo, OTUQueryParams, CACHE_FOREVER, ContextualFilter, TaxonomyFilter
 from ...spatial import spatial_query
+from ...site_images import refresh_site_image_lookup_table
 from ...otu import OTUKingdom, OTUAmplicon
 from collections import OrderedDict
 
@@ -33,6 +34,16 @@ class Command(BaseCommand):
         spatial_query(params, cache_duration=CACHE_FOREVER, force_cache=True)
         print("Complete")
 
+    def warm_site_images(self):
+        print("Building site image lookup table")
+        try:
+            refresh_site_image_lookup_table()
+        except Exception as e:
+            # CKAN may be unavailable: the scheduled refresh will retry
+            print("Failed: {}".format(e))
+            return
+        print("Complete")
+
     def handle(self, *args, **kwargs):
         self.kingdom_possibilities = [None]
         self.amplicon_possibilities = [None]
@@ -43,3 +54,4 @@ class Command(BaseCommand):
 
         self.warm_taxonomies()
         self.warm_map()
+        self.warm_site_images()
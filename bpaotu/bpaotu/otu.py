@@ -382,6 +382,44 @@ class SampleOTU(SchemaMixin, Base):
         return "<SampleOTU(%d,%d,%d)>" % (self.sample_id, self.otu_id, self.count)
 
 
+class SampleAmpliconCount(SchemaMixin, Base):
+    """
+    total OTU count for each sample, per amplicon. built by the importer from
+    SampleOTU, used as the denominator for relative abundance
+    """
+    __tablename__ = 'sample_amplicon_count'
+    sample_id = Column(Integer, ForeignKey(SCHEMA + '.sample_context.id'), nullable=False, primary_key=True, index=True)
+    amplicon_id = Column(
+        Integer, ForeignKey(SCHEMA + '.ontology_otuamplicon.id'), nullable=False, primary_key=True, index=True)
+    count = Column(postgresql.BIGINT, nullable=False)
+
+    def __repr__(self):
+        return "<SampleAmpliconCount(%d,%d,%d)>" % (self.sample_id, self.amplicon_id, self.count)
+
+
+class SampleTaxonCount(SchemaMixin, Base):
+    """
+    OTU count for each sample, rolled up by amplicon and taxonomy: OTUs sharing
+    the same taxonomy are summed. this has the same taxonomy columns as OTU, so
+    TaxonomyFilter may be applied to it directly.
+    """
+    __tablename__ = 'sample_taxon_count'
+    id = Column(Integer, primary_key=True)
+    sample_id = Column(Integer, ForeignKey(SCHEMA + '.sample_context.id'), nullable=False, index=True)
+    kingdom_id = ontology_fkey(OTUKingdom, index=True)
+    phylum_id = ontology_fkey(OTUPhylum, index=True)
+    class_id = ontology_fkey(OTUClass, index=True)
+    order_id = ontology_fkey(OTUOrder, index=True)
+    family_id = ontology_fkey(OTUFamily, index=True)
+    genus_id = ontology_fkey(OTUGenus, index=True)
+    species_id = ontology_fkey(OTUSpecies, index=True)
+    amplicon_id = ontology_fkey(OTUAmplicon, index=True)
+    count = Column(postgresql.BIGINT, nullable=False)
+
+    def __repr__(self):
+        return "<SampleTaxonCount(%d,%d,%d)>" % (self.sample_id, self.amplicon_id, self.count)
+
+
 class OntologyErrors(SchemaMixin, Base):
     __tablename__ = 'ontology_errors'
     id = Column(Integer, primary_key=True)
@@ -410,6 +448,9 @@ class ImportMetadata(SchemaMixin, Base):
     sampleotu_count = Column(postgresql.BIGINT)
     samplecontext_count = Column(postgresql.BIGINT)
     uuid = Column(String)
+    # import duration (seconds), and the time and throughput of each stage
+    elapsed = Column(Float)
+    stage_timings = Column(postgresql.JSONB)
 
 
 class ImportedFile(SchemaMixin, Base):
@@ -420,10 +461,13 @@ class ImportedFile(SchemaMixin, Base):
     file_size = Column(postgresql.BIGINT)
     rows_imported = Column(postgresql.BIGINT)
     rows_skipped = Column(postgresql.BIGINT)
+    elapsed = Column(Float)
+    bytes_decompressed = Column(postgresql.BIGINT)
+    rows_per_second = Column(Float)
 
 
-def make_engine():
+def make_engine(**kwargs):
     conf = settings.DATABASES['default']
     engine_string = 'postgres://%(USER)s:%(PASSWORD)s@%(HOST)s:%(PORT)s/%(NAME)s' % (conf)
     echo = os.environ.get('BPAOTU_ECHO') == '1'
-    return create_engine(engine_string, echo=echo)
+    return create_engine(engine_string, echo=echo, **kwargs)
@@ -4,6 +4,7 @@ from itertools import chain
 import logging
 
 import sqlalchemy
+from sqlalchemy.dialects.postgresql import aggregate_order_by
 from sqlalchemy.orm import sessionmaker, aliased
 
 from django.core.cache import caches
@@ -20,8 +21,10 @@ from .otu import (
     OTUFamily,
     OTUGenus,
     OTUSpecies,
+    SampleAmpliconCount,
     SampleContext,
     SampleOTU,
+    SampleTaxonCount,
     ImportMetadata,
     ImportedFile,
     ExcludedSamples,
@@ -50,12 +53,19 @@ def make_cache_key(*args):
     something that is stable, and which completely represents the state of the
     object for the cache
     """
+    key = metadata_uuid() + ':' + ':'.join(repr(t) for t in args)
+    return sha256(key.encode('utf8')).hexdigest()
+
+
+def metadata_uuid():
+    """
+    the UUID of the current import: changes every time the importer is run
+    """
     global __METADATA_UUID
     if __METADATA_UUID is None:
         with MetadataInfo() as info:
             __METADATA_UUID = info.import_metadata().uuid
-    key = __METADATA_UUID + ':' + ':'.join(repr(t) for t in args)
-    return sha256(key.encode('utf8')).hexdigest()
+    return __METADATA_UUID
 
 
 class OTUQueryParams:
@@ -366,6 +376,64 @@ class SampleQuery:
         q = self._assemble_sample_query(q, subq).order_by(SampleContext.id)
         return self._q_all_cached('matching_samples', q)
 
+    def matching_sample_columns(self, *args):
+        """
+        a query over the given columns, for the samples matching the query. as with
+        matching_sample_otus, this is not cached: the caller may further filter and
+        aggregate the query
+        """
+        q = self._session.query(*args)
+        subq = self._build_taxonomy_subquery()
+        return self._assemble_sample_query(q, subq)
+
+    def matching_sample_sites(self):
+        """
+        the samples matching the query, grouped by location. returns a list of
+        (latitude, longitude, sample_count, [sample_id, ...])
+        """
+        q = self._session.query(
+            SampleContext.latitude,
+            SampleContext.longitude,
+            sqlalchemy.func.count(SampleContext.id),
+            sqlalchemy.func.array_agg(aggregate_order_by(SampleContext.id, SampleContext.id))) \
+            .group_by(SampleContext.latitude, SampleContext.longitude)
+        subq = self._build_taxonomy_subquery()
+        q = self._assemble_sample_query(q, subq)
+        return self._q_all_cached('matching_sample_sites', q)
+
+    def matching_sample_site_abundance(self):
+        """
+        the samples matching the query, grouped by location, with the summed OTU count
+        for the taxonomy filter and the summed total OTU count (for the amplicon filter)
+        of the samples at each site. returns a list of
+        (latitude, longitude, sample_count, taxon_count, total_count)
+
+        this is computed from the rollup tables built by the importer, rather than
+        from SampleOTU.
+        """
+        taxon_q = self._session.query(
+            SampleTaxonCount.sample_id,
+            sqlalchemy.func.sum(SampleTaxonCount.count).label('count')) \
+            .group_by(SampleTaxonCount.sample_id)
+        taxon_subq = self._taxonomy_filter.apply(taxon_q, table=SampleTaxonCount).subquery()
+        total_q = self._session.query(
+            SampleAmpliconCount.sample_id,
+            sqlalchemy.func.sum(SampleAmpliconCount.count).label('count')) \
+            .group_by(SampleAmpliconCount.sample_id)
+        total_subq = apply_amplicon_filter(
+            total_q, self._taxonomy_filter.amplicon_filter, table=SampleAmpliconCount).subquery()
+        q = self._session.query(
+            SampleContext.latitude,
+            SampleContext.longitude,
+            sqlalchemy.func.count(SampleContext.id),
+            sqlalchemy.func.sum(taxon_subq.c.count),
+            sqlalchemy.func.sum(total_subq.c.count)) \
+            .join(taxon_subq, taxon_subq.c.sample_id == SampleContext.id) \
+            .join(total_subq, total_subq.c.sample_id == SampleContext.id) \
+            .group_by(SampleContext.latitude, SampleContext.longitude)
+        q = self._contextual_filter.apply(q)
+        return self._q_all_cached('matching_sample_site_abundance', q)
+
     def matching_otus(self, kingdom_id=None):
         q = self._session.query(OTU)
         subq = self._build_contextual_subquery()
@@ -477,10 +545,13 @@ class TaxonomyFilter:
     def is_empty(self):
         return not self.amplicon_filter and self.state_vector[0] is None
 
-    def apply(self, q):
-        q = apply_amplicon_filter(q, self.amplicon_filter)
+    def apply(self, q, table=OTU):
+        """
+        filter `q` on the taxonomy columns of `table`, which defaults to OTU
+        """
+        q = apply_amplicon_filter(q, self.amplicon_filter, table=table)
         for (otu_attr, ontology_class), taxonomy in zip(TaxonomyOptions.hierarchy, self.state_vector):
-            q = apply_otu_filter(otu_attr, q, taxonomy)
+            q = apply_otu_filter(otu_attr, q, taxonomy, table=table)
         return q
 
     def __repr__(self):
@@ -680,6 +751,13 @@ def get_sample_ids():
     return ids
 
 
+def get_samples(sample_ids):
+    session = Session()
+    samples = session.query(SampleContext).filter(SampleContext.id.in_(sample_ids)).order_by(SampleContext.id).all()
+    session.close()
+    return samples
+
+
 OP_DESCR = {
     'is': ' is ',
     'isnot': ' is not ',
@@ -703,8 +781,8 @@ def apply_op_and_val_filter(attr, q, op_and_val):
     return q
 
 
-def apply_otu_filter(otu_attr, q, op_and_val):
-    return apply_op_and_val_filter(getattr(OTU, otu_attr), q, op_and_val)
+def apply_otu_filter(otu_attr, q, op_and_val, table=OTU):
+    return apply_op_and_val_filter(getattr(table, otu_attr), q, op_and_val)
 
 
 apply_amplicon_filter = partial(apply_otu_filter, 'amplicon_id')
@@ -0,0 +1,123 @@
+import gzip
+import io
+import os
+import queue
+import shutil
+import subprocess
+import threading
+
+
+# decompressed data is handed to the reader in blocks of this size; at most
+# QUEUE_DEPTH blocks are read ahead of it
+BLOCK_SIZE = 1024 * 1024
+QUEUE_DEPTH = 16
+
+# marks the end of the stream in the queue
+_EOF = object()
+
+
+class ReadaheadGzipReader(io.RawIOBase):
+    """
+    a binary stream of the decompressed contents of a gzip file. decompression
+    happens in a separate thread (or, if pigz is installed, in a pigz process
+    feeding that thread), overlapping with whatever is parsing the stream.
+    """
+
+    def __init__(self, path, use_pigz=True):
+        super().__init__()
+        self.path = path
+        self._queue = queue.Queue(maxsize=QUEUE_DEPTH)
+        self._stopping = threading.Event()
+        self._buffer = memoryview(b'')
+        self._eof = False
+        self._process = None
+        # total bytes decompressed so far
+        self.bytes_decompressed = 0
+        self._compressed = open(path, 'rb')
+        pigz = shutil.which('pigz') if use_pigz else None
+        if pigz is not None:
+            self._process = subprocess.Popen([pigz, '-dc'], stdin=self._compressed, stdout=subprocess.PIPE)
+            self._source = self._process.stdout
+        else:
+            self._source = gzip.GzipFile(fileobj=self._compressed, mode='rb')
+        self._thread = threading.Thread(target=self._read_ahead, name='readahead', daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        # give up if the reader has gone away
+        while not self._stopping.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _read_ahead(self):
+        try:
+            while True:
+                block = self._source.read(BLOCK_SIZE)
+                if not block:
+                    break
+                self.bytes_decompressed += len(block)
+                if not self._put(block):
+                    return
+            if self._process is not None and self._process.wait() != 0:
+                raise IOError('pigz exited with status {}: {}'.format(self._process.returncode, self.path))
+            self._put(_EOF)
+        except Exception as e:
+            self._put(e)
+
+    @property
+    def compressed_position(self):
+        "how far through the compressed file decompression has read"
+        # the file offset is shared with pigz, which inherits the file
+        return os.lseek(self._compressed.fileno(), 0, os.SEEK_CUR)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            if self._eof:
+                return 0
+            item = self._queue.get()
+            if item is _EOF:
+                self._eof = True
+                return 0
+            if isinstance(item, Exception):
+                self._eof = True
+                raise item
+            self._buffer = memoryview(item)
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        self._stopping.set()
+        if self._process is not None:
+            self._process.kill()
+        self._thread.join()
+        self._source.close()
+        if self._process is not None:
+            self._process.wait()
+        self._compressed.close()
+        super().close()
+
+
+def open_gzip(path, mode='rb', encoding='utf-8'):
+    "open a gzip file for reading, as gzip.open, with decompression read ahead in the background"
+    stream = io.BufferedReader(ReadaheadGzipReader(path), buffer_size=BLOCK_SIZE)
+    if mode == 'rb':
+        return stream
+    if mode == 'rt':
+        return io.TextIOWrapper(stream, encoding=encoding)
+    raise ValueError('unsupported mode: {}'.format(mode))
+
+
+def source_reader(stream):
+    "the ReadaheadGzipReader underlying a stream returned by open_gzip"
+    return getattr(stream, 'buffer', stream).raw
@@ -154,6 +154,33 @@ STATIC_SERVER_PATH = STATIC_ROOT
 
 BLAST_RESULTS_PATH = env.get('blast_results_path', '/data/blast-output/')
 BLAST_RESULTS_URL = env.get('blast_results_url', STATIC_URL)
+# BLAST databases of the OTUs (one per amplicon) are built here at import
+BLAST_DB_PATH = env.get('blast_db_path', '/data/blast-db/')
+BLAST_THREADS = env.get('blast_threads', 4)
+# each amplicon's BLAST database is split into shards of at most this many OTUs,
+# which are searched in parallel by Celery workers
+BLAST_DB_SHARD_SIZE = env.get('blast_db_shard_size', 250000)
+# working directory of BLAST searches: must be shared by all Celery workers
+BLAST_WORKING_PATH = env.get('blast_working_path', '/data/blast-work/')
+# the k-mer (minimizer) index of OTU codes, used by sequence search, is built here at import
+KMER_INDEX_PATH = env.get('kmer_index_path', '/data/kmer-index/')
+# upper bound on the number of OTUs matched by a BLAST search
+BLAST_MAX_TARGET_SEQS = env.get('blast_max_target_seqs', 100000)
+# finished exports are cached on disk, keyed by import and query. the cache is
+# bounded to EXPORT_CACHE_QUOTA bytes (least recently used exports are evicted);
+# a quota of zero disables the cache
+EXPORT_CACHE_PATH = env.get('export_cache_path', '/data/export-cache/')
+EXPORT_CACHE_QUOTA = env.get('export_cache_quota', 20 * 1024 * 1024 * 1024)
+# if non-zero, the per-kingdom CSVs within the tabular export are rendered
+# concurrently using this many threads (each with its own database connection)
+EXPORT_PARALLEL_WORKERS = env.get('export_parallel_workers', 0)
+# compression of exports: the 'zipstream' backend compresses on a single core;
+# the 'parallel' backend deflates blocks concurrently across
+# EXPORT_COMPRESSION_THREADS threads. the level is 'store' (no compression)
+# or a deflate level from 1 to 9. clients may request a level per-export.
+EXPORT_COMPRESSION_BACKEND = env.get('export_compression_backend', 'zipstream')
+EXPORT_COMPRESSION_LEVEL = env.get('export_compression_level', '6')
+EXPORT_COMPRESSION_THREADS = env.get('export_compression_threads', 4)
 STATICFILES_DIRS = [
     BLAST_RESULTS_PATH,
 ]
@@ -373,6 +400,30 @@ CELERY_RESULT_SERIALIZER = 'json'
 
 CELERY_TIMEZONE = TIME_ZONE
 
+# shared HTTP sessions (CKAN, Galaxy): connections pooled per host, timeouts in seconds,
+# and retries (with backoff) of connection failures and idempotent requests
+HTTP_POOL_MAXSIZE = env.get('http_pool_maxsize', 10)
+HTTP_CONNECT_TIMEOUT = env.get('http_connect_timeout', 10)
+HTTP_READ_TIMEOUT = env.get('http_read_timeout', 300)
+HTTP_MAX_RETRIES = env.get('http_max_retries', 3)
+
+# how often (seconds) the site image lookup table is rebuilt from CKAN
+SITE_IMAGE_LOOKUP_REFRESH_INTERVAL = env.get('site_image_lookup_refresh_interval', 60 * 60)
+
+# thumbnails of site images are pre-generated into this directory
+SITE_IMAGE_THUMBNAIL_PATH = env.get('site_image_thumbnail_path', '/data/site-image-thumbnails/')
+# serve thumbnails via the frontend web server: '' (serve from Django), 'x-sendfile' or 'x-accel-redirect'
+SITE_IMAGE_THUMBNAIL_SENDFILE = env.get('site_image_thumbnail_sendfile', '')
+# for x-accel-redirect, the nginx internal location which maps to SITE_IMAGE_THUMBNAIL_PATH
+SITE_IMAGE_THUMBNAIL_ACCEL_PREFIX = env.get('site_image_thumbnail_accel_prefix', '/site-image-thumbnails/')
+
+CELERY_BEAT_SCHEDULE = {
+    'refresh-site-image-lookup-table': {
+        'task': 'bpaotu.tasks.refresh_site_image_lookup_table',
+        'schedule': SITE_IMAGE_LOOKUP_REFRESH_INTERVAL,
+    },
+}
+
 # End Celery
 
 CACHES['search_results'] = CACHES['default']
@@ -387,6 +438,10 @@ CHMOD_GROUP = env.get("repo_group", "apache")
 # where it belongs
 TEST_RUNNER = 'django.test.runner.DiscoverRunner'
 
+# if set, and prometheus_client is installed, the importer exports its progress
+# as prometheus metrics on this port
+IMPORT_METRICS_PORT = env.get('import_metrics_port', 0)
+
 # ingest all
 DOWNLOADS_CHECKER_USER = env.get('downloads_checker_user', 'downloads_checker')
 DOWNLOADS_CHECKER_PASS = env.get('downloads_checker_pass', 'ch3ck3r')
@@ -406,4 +461,12 @@ GALAXY_BASE_URL = env.get('galaxy_base_url', 'https://galaxy-aust-dev.genome.edu
 GALAXY_ADMIN_USER_API_KEY = env.get('galaxy_admin_user_api_key', '')
 GALAXY_INTEGRATION = GALAXY_ADMIN_USER_API_KEY != ''
 GALAXY_KRONA_WORKFLOW_ID = env.get('galaxy_krona_workflow_id', 'bf002aa8f96f4e7b')
+# the Galaxy upload watcher: maximum concurrent status checks, and how long (seconds)
+# to wait for an upload to finish before giving up
+GALAXY_UPLOAD_WATCHER_CONCURRENCY = env.get('galaxy_upload_watcher_concurrency', 10)
+GALAXY_UPLOAD_WATCH_TIMEOUT = env.get('galaxy_upload_watch_timeout', 6 * 60 * 60)
+# how long (seconds) an uploaded BIOM dataset may be reused by an identical Galaxy submission
+GALAXY_SUBMISSION_INDEX_TTL = env.get('galaxy_submission_index_ttl', 7 * 24 * 60 * 60)
+# how long (seconds) to cache the Galaxy user ID and API key for an email address
+GALAXY_USER_CACHE_TTL = env.get('galaxy_user_cache_ttl', 600)
 NONDENOISED_REQUEST_EMAIL = env.get('nondenoised_request_email', 'am-data-requests@bioplatforms.com')
@@ -1,28 +1,43 @@
 from django.core.cache import caches
+from django.core.exceptions import PermissionDenied
 from django.conf import settings
 from collections import defaultdict
+from contextlib import suppress
 
 import ckanapi
-import mimetypes
+import os
+import tempfile
+import time
 
-import requests
 from io import BytesIO
 from PIL import Image
-from django.http import HttpResponseForbidden
+
+from .http_client import get_session
 
 import logging
 logger = logging.getLogger("rainbow")
 
 
 THUMBNAIL_SIZE = 480
-CACHE_1DAY = (60 * 60 * 24)
+# thumbnails are pre-generated at each of these sizes (maximum width and height)
+THUMBNAIL_SIZES = (120, 480)
+THUMBNAIL_EXTENSION = '.jpg'
 SITE_IMAGE_DATA_TYPE = 'base-site-image'
 LOOKUP_TABLE_KEY = 'CKAN_IMAGE_LOOKUP_TABLE'
+# small key, holding the time at which the lookup table was last built
+LOOKUP_TABLE_VERSION_KEY = 'CKAN_IMAGE_LOOKUP_TABLE_VERSION'
+LOOKUP_TABLE_REFRESH_LOCK_KEY = 'CKAN_IMAGE_LOOKUP_TABLE_REFRESH'
 image_cache = caches['image_results']
 
+# per-process copy of the lookup table: (version, lookup_table)
+_lookup_table_local = (None, {})
+
 
 def make_ckan_remote():
-    return ckanapi.RemoteCKAN(settings.CKAN_SERVER['base_url'], apikey=settings.CKAN_SERVER['api_key'])
+    return ckanapi.RemoteCKAN(
+        settings.CKAN_SERVER['base_url'],
+        apikey=settings.CKAN_SERVER['api_key'],
+        session=get_session())
 
 
 def _get_image_packages():
@@ -67,43 +82,166 @@ def _build_lookup_table():
     return dict(lookup_table)
 
 
+def refresh_site_image_lookup_table():
+    '''
+    Build the lookup table of all images in CKAN, and store it in the cache.
+    Run periodically by Celery beat (see CELERY_BEAT_SCHEDULE).
+    '''
+    lookup_table = _build_lookup_table()
+    # the table is stored without expiry: the last known table is always
+    # served, while a newer one is built in the background
+    image_cache.set(LOOKUP_TABLE_KEY, lookup_table, None)
+    image_cache.set(LOOKUP_TABLE_VERSION_KEY, time.time(), None)
+    image_cache.delete(LOOKUP_TABLE_REFRESH_LOCK_KEY)
+    logger.info('site image lookup table refreshed: {} sites'.format(len(lookup_table)))
+    return lookup_table
+
+
+def _request_refresh():
+    # only queue one refresh at a time, no matter how many processes notice
+    # that the table is missing or stale
+    if not image_cache.add(LOOKUP_TABLE_REFRESH_LOCK_KEY, True, settings.SITE_IMAGE_LOOKUP_REFRESH_INTERVAL):
+        return
+    from .tasks import refresh_site_image_lookup_table as refresh_task
+    refresh_task.delay()
+
+
 def get_site_image_lookup_table():
     '''
-    Get lookup table of all images in CKAN from cache,
-    or alternatively build it and add it to the cache.
+    Get lookup table of all images in CKAN. This never calls out to CKAN:
+    the last known table is returned (or an empty table, if none has been
+    built yet), and a refresh is requested in the background if the table is
+    missing or stale.
+
+    The table is only fetched from the cache when it has changed; otherwise
+    this process's copy is used.
     '''
+    global _lookup_table_local
 
-    lookup_table = image_cache.get(LOOKUP_TABLE_KEY)
-    if lookup_table:
+    version = image_cache.get(LOOKUP_TABLE_VERSION_KEY)
+    if version is None or time.time() - version > 2 * settings.SITE_IMAGE_LOOKUP_REFRESH_INTERVAL:
+        _request_refresh()
+    local_version, lookup_table = _lookup_table_local
+    if version is None or version == local_version:
         return lookup_table
-    lookup_table = _build_lookup_table()
-    image_cache.set(LOOKUP_TABLE_KEY, lookup_table, CACHE_1DAY)
+    lookup_table = image_cache.get(LOOKUP_TABLE_KEY)
+    if lookup_table is None:
+        # evicted underneath the version key
+        _request_refresh()
+        return _lookup_table_local[1]
+    _lookup_table_local = (version, lookup_table)
     return lookup_table
 
 
-def resize_image(content):
-    with Image.open(BytesIO(content)) as img_obj:
-        # Resizing an image while maintaining aspect ratio:
-        # https://stackoverflow.com/questions/24745857/python-pillow-how-to-scale-an-image/24745969
-        maxsize = (THUMBNAIL_SIZE, THUMBNAIL_SIZE)
-        img_obj.thumbnail(maxsize, Image.ANTIALIAS)
-        # Needed fix for some cases with Alpha channel
-        img_obj = img_obj.convert('RGB')
+def resize_image(img_obj, size=THUMBNAIL_SIZE):
+    img_obj = img_obj.copy()
+    # Resizing an image while maintaining aspect ratio:
+    # https://stackoverflow.com/questions/24745857/python-pillow-how-to-scale-an-image/24745969
+    maxsize = (size, size)
+    img_obj.thumbnail(maxsize, Image.ANTIALIAS)
+    # Needed fix for some cases with Alpha channel
+    img_obj = img_obj.convert('RGB')
 
-        with BytesIO() as img_buf:
-            img_obj.save(img_buf, format='JPEG')
-            img_data = img_buf.getvalue()
+    with BytesIO() as img_buf:
+        img_obj.save(img_buf, format='JPEG')
+        img_data = img_buf.getvalue()
     return img_data
 
 
-def fetch_image(package_id, resource_id):
-    # security: we do not want this API endpoint to be used to retrieve
+def thumbnail_path(resource_id, size):
+    r'''
+    Path of the thumbnail of `resource_id` at `size` within the thumbnail store.
+    Resource IDs are restricted to [\w-]+ by the URL pattern.
+    '''
+    return os.path.join(settings.SITE_IMAGE_THUMBNAIL_PATH, str(size), resource_id + THUMBNAIL_EXTENSION)
+
+
+def _write_thumbnail(path, img_data):
+    # write atomically, so a partially written thumbnail is never served
+    target_dir = os.path.dirname(path)
+    os.makedirs(target_dir, exist_ok=True)
+    fd, partial_path = tempfile.mkstemp(dir=target_dir, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as thumbnail_fd:
+            thumbnail_fd.write(img_data)
+        os.chmod(partial_path, 0o644)
+        os.replace(partial_path, path)
+    except:  # noqa
+        with suppress(OSError):
+            os.unlink(partial_path)
+        raise
+
+
+def render_thumbnails(package_id, resource_id, sizes=THUMBNAIL_SIZES):
+    '''
+    Fetch the image from CKAN, and write a thumbnail at each of `sizes` into
+    the thumbnail store.
+    '''
+    # security: we do not want the thumbnail store to be used to retrieve
     # any data that is not a BASE site image.
     resource = _get_and_verify_resource(package_id, resource_id)
     if resource is None:
-        raise HttpResponseForbidden()
-    img_url = resource['url']
-    content_type, _ = mimetypes.guess_type(img_url)
-    r = requests.get(img_url, headers={'Authorization': settings.CKAN_SERVER['api_key']})
-    img_data = resize_image(r.content)
-    return (BytesIO(img_data), content_type)
+        raise PermissionDenied()
+    r = get_session().get(
+        resource['url'],
+        headers={'Authorization': settings.CKAN_SERVER['api_key']})
+    r.raise_for_status()
+    with Image.open(BytesIO(r.content)) as img_obj:
+        for size in sizes:
+            _write_thumbnail(thumbnail_path(resource_id, size), resize_image(img_obj, size))
+
+
+def get_thumbnail(package_id, resource_id, size):
+    '''
+    Path to the thumbnail, rendering it on demand if it hasn't been
+    pre-generated yet.
+    '''
+    path = thumbnail_path(resource_id, size)
+    if not os.access(path, os.R_OK):
+        logger.info('thumbnail not pre-generated, rendering: {}'.format(path))
+        render_thumbnails(package_id, resource_id)
+    return path
+
+
+def generate_thumbnails():
+    '''
+    Render any missing thumbnails for the images in the site image lookup
+    table, and remove thumbnails of images which are no longer in CKAN.
+    '''
+    lookup_table = image_cache.get(LOOKUP_TABLE_KEY)
+    if lookup_table is None:
+        logger.warning('site image lookup table not built yet, skipping thumbnail generation')
+        return
+
+    resource_ids = set()
+    rendered = failed = 0
+    for images in lookup_table.values():
+        for image in images:
+            package_id, resource_id = image['package_id'], image['resource_id']
+            resource_ids.add(resource_id)
+            if all(os.access(thumbnail_path(resource_id, size), os.R_OK) for size in THUMBNAIL_SIZES):
+                continue
+            try:
+                render_thumbnails(package_id, resource_id)
+                rendered += 1
+            except Exception:
+                logger.exception('unable to render thumbnail: {}/{}'.format(package_id, resource_id))
+                failed += 1
+
+    removed = 0
+    # an empty table is more likely a failed CKAN fetch than no site images
+    # at all: keep the thumbnails we have
+    if not lookup_table:
+        logger.warning('site image lookup table is empty, not removing thumbnails')
+        return
+    for size in THUMBNAIL_SIZES:
+        size_dir = os.path.dirname(thumbnail_path('', size))
+        with suppress(FileNotFoundError):
+            for filename in os.listdir(size_dir):
+                if not filename.endswith(THUMBNAIL_EXTENSION) or \
+                        filename[:-len(THUMBNAIL_EXTENSION)] in resource_ids:
+                    continue
+                with suppress(FileNotFoundError):
+                    os.unlink(os.path.join(size_dir, filename))
+                removed += 1
+    logger.info('thumbnails: {} rendered, {} failed, {} removed'.format(rendered, failed, removed))
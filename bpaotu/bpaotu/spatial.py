@@ -1,9 +1,13 @@
+import math
 from collections import defaultdict
 
+import sqlalchemy
+from sqlalchemy import Integer, func
 from django.core.cache import caches
 from .query import (
     OntologyInfo,
     SampleQuery,
+    get_samples,
     make_cache_key,
     CACHE_7DAYS)
 from .otu import (
@@ -17,6 +21,54 @@ from bpaingest.projects.amdb.contextual import AustralianMicrobiomeSampleContext
 
 logger = logging.getLogger("rainbow")
 
+# server-side clustering of sample sites: sites are grouped into a grid of
+# CLUSTER_GRID x CLUSTER_GRID cells within each web mercator (slippy map) tile
+CLUSTER_GRID = 4
+MAX_CLUSTER_ZOOM = 18
+MAX_CLUSTER_TILES = 256
+MAX_LATITUDE = 85.0511287798
+
+
+class SpatialError(Exception):
+    pass
+
+
+def _contextual_data_fn(info):
+    """
+    returns a function which maps a SampleContext to a dict of its
+    contextual data (display title -> value), omitting blank values
+    """
+    def make_ontology_export(ontology_cls):
+        values = dict(info.get_values(ontology_cls))
+
+        def _ontology_lookup(x):
+            if x is None:
+                return ''
+            return values[x]
+        return _ontology_lookup
+
+    field_units = AustralianMicrobiomeSampleContextual.units_for_fields()
+    write_fns = {}
+    for column in SampleContext.__table__.columns:
+        fn = str_none_blank
+        if column.name == 'id':
+            fn = format_sample_id
+        elif hasattr(column, "ontology_class"):
+            fn = make_ontology_export(column.ontology_class)
+        units = field_units.get(column.name)
+        title = SampleContext.display_name(column.name)
+        if units:
+            title += ' [%s]' % units
+        write_fns[column.name] = (title, fn)
+
+    def samples_contextual_data(sample):
+        return {
+            f: v
+            for f, v in ((title, fn(getattr(sample, fld))) for fld, (title, fn) in sorted(write_fns.items()))
+            if not (v is None or v.strip() == '')
+        }
+    return samples_contextual_data
+
 
 def _spatial_query(params):
     """
@@ -24,39 +76,11 @@ def _spatial_query(params):
     (see below)
     """
     with OntologyInfo() as info:
-        def make_ontology_export(ontology_cls):
-            values = dict(info.get_values(ontology_cls))
-
-            def _ontology_lookup(x):
-                if x is None:
-                    return ''
-                return values[x]
-            return _ontology_lookup
-
-        field_units = AustralianMicrobiomeSampleContextual.units_for_fields()
-        write_fns = {}
-        for column in SampleContext.__table__.columns:
-            fn = str_none_blank
-            if column.name == 'id':
-                fn = format_sample_id
-            elif hasattr(column, "ontology_class"):
-                fn = make_ontology_export(column.ontology_class)
-            units = field_units.get(column.name)
-            title = SampleContext.display_name(column.name)
-            if units:
-                title += ' [%s]' % units
-            write_fns[column.name] = (title, fn)
+        samples_contextual_data = _contextual_data_fn(info)
 
         with SampleQuery(params) as query:
             samples = query.matching_samples()
 
-        def samples_contextual_data(sample):
-            return {
-                f: v
-                for f, v in ((title, fn(getattr(sample, fld))) for fld, (title, fn) in sorted(write_fns.items()))
-                if not (v is None or v.strip() == '')
-            }
-
         result = defaultdict(lambda: defaultdict(dict))
         for sample in samples:
             latlng = result[(sample.latitude, sample.longitude)]
@@ -86,6 +110,154 @@ def spatial_query(params, cache_duration=CACHE_7DAYS, force_cache=False):
     return result
 
 
+def spatial_site_query(params):
+    """
+    a lightweight alternative to spatial_query(): returns only the location of each
+    site, with the number and IDs of the matching samples at that site. contextual
+    data for the samples at a site may then be retrieved with spatial_sample_details()
+
+    the aggregation is performed by the database; the result is cached by
+    SampleQuery
+    """
+    with SampleQuery(params) as query:
+        sites = query.matching_sample_sites()
+    return [{
+        'latitude': latitude,
+        'longitude': _corrected_longitude(longitude),
+        'sample_count': sample_count,
+        'sample_ids': sample_ids,
+    } for latitude, longitude, sample_count, sample_ids in sites]
+
+
+def spatial_abundance_query(params):
+    """
+    the sites matching the query, with the OTU count for the selected taxonomy
+    summed over the samples at each site, and its abundance relative to the
+    total OTU count of those samples (within the selected amplicon, if any.)
+    """
+    with SampleQuery(params) as query:
+        sites = query.matching_sample_site_abundance()
+    result = []
+    for latitude, longitude, sample_count, taxon_count, total_count in sites:
+        # sums of BIGINT columns come back as Decimal
+        taxon_count, total_count = int(taxon_count or 0), int(total_count or 0)
+        result.append({
+            'latitude': latitude,
+            'longitude': _corrected_longitude(longitude),
+            'sample_count': sample_count,
+            'count': taxon_count,
+            'total_count': total_count,
+            'relative_abundance': (taxon_count / total_count) if total_count else None,
+        })
+    return result
+
+
+def spatial_sample_details(sample_ids):
+    """
+    the contextual data for the given samples, as provided in the `bpa_data`
+    of spatial_query()
+    """
+    with OntologyInfo() as info:
+        samples_contextual_data = _contextual_data_fn(info)
+        return {
+            sample.id: samples_contextual_data(sample)
+            for sample in get_samples(sample_ids)}
+
+
+def _tile_x(lng, zoom):
+    return int(math.floor((lng + 180.0) / 360.0 * (2 ** zoom)))
+
+
+def _tile_y(lat, zoom):
+    n = 2 ** zoom
+    lat_rad = math.radians(max(min(lat, MAX_LATITUDE), -MAX_LATITUDE))
+    y = int(math.floor((1.0 - math.log(math.tan(lat_rad) + 1.0 / math.cos(lat_rad)) / math.pi) / 2.0 * n))
+    return max(min(y, n - 1), 0)
+
+
+def tiles_for_bounds(south, west, north, east, zoom):
+    """
+    the (x, y) of each tile at `zoom` which intersects the given bounds. longitude
+    may be outside of [-180, 180) (the map wraps), x is normalised.
+    """
+    n = 2 ** zoom
+    x_from, x_to = _tile_x(west, zoom), _tile_x(east, zoom)
+    y_from, y_to = _tile_y(north, zoom), _tile_y(south, zoom)
+    xs = sorted(set(x % n for x in range(x_from, min(x_to, x_from + n - 1) + 1)))
+    tiles = [(x, y) for x in xs for y in range(y_from, y_to + 1)]
+    if len(tiles) > MAX_CLUSTER_TILES:
+        raise SpatialError("too many tiles requested")
+    return tiles
+
+
+def _cluster_cells(zoom):
+    """
+    SQL expressions for the x and y grid cell of each sample, at `zoom`
+    """
+    n = (2 ** zoom) * CLUSTER_GRID
+    lat_rad = func.radians(func.greatest(func.least(SampleContext.latitude, MAX_LATITUDE), -MAX_LATITUDE))
+    x = sqlalchemy.cast(func.floor((SampleContext.longitude + 180.0) / 360.0 * n), Integer) % n
+    y = sqlalchemy.cast(func.floor(
+        (1.0 - func.ln(func.tan(lat_rad) + 1.0 / func.cos(lat_rad)) / math.pi) / 2.0 * n), Integer)
+    y = func.greatest(func.least(y, n - 1), 0)
+    return x, y
+
+
+def _spatial_cluster_query(params, zoom, tiles):
+    """
+    returns {(x, y): [cluster, ...]} for each of `tiles`
+    """
+    cell_x, cell_y = _cluster_cells(zoom)
+    with SampleQuery(params) as query:
+        q = query.matching_sample_columns(
+            cell_x,
+            cell_y,
+            func.count(SampleContext.id),
+            func.count(sqlalchemy.distinct(sqlalchemy.tuple_(SampleContext.latitude, SampleContext.longitude))),
+            func.avg(SampleContext.latitude),
+            func.avg(SampleContext.longitude))
+        q = q.filter(SampleContext.latitude.isnot(None), SampleContext.longitude.isnot(None)) \
+            .filter(sqlalchemy.tuple_(cell_x / CLUSTER_GRID, cell_y / CLUSTER_GRID).in_(tiles)) \
+            .group_by(cell_x, cell_y)
+        rows = q.all()
+
+    result = dict((tile, []) for tile in tiles)
+    for x, y, sample_count, site_count, latitude, longitude in rows:
+        result[(x // CLUSTER_GRID, y // CLUSTER_GRID)].append({
+            'latitude': latitude,
+            'longitude': _corrected_longitude(longitude),
+            'sample_count': sample_count,
+            'site_count': site_count,
+        })
+    return result
+
+
+def spatial_cluster_query(params, bounds, zoom):
+    """
+    pre-aggregated clusters of sample sites for the map, for the area within
+    `bounds` (south, west, north, east) at `zoom`. clusters are cached per
+    (query, zoom, tile); only tiles not already in the cache are queried.
+    """
+    zoom = max(min(int(zoom), MAX_CLUSTER_ZOOM), 0)
+    tiles = tiles_for_bounds(*bounds, zoom)
+    cache = caches['search_results']
+    keys = dict(
+        (tile, make_cache_key('spatial_cluster_query', params.state_key, zoom, tile))
+        for tile in tiles)
+    cached = cache.get_many(keys.values())
+
+    missing = [tile for tile in tiles if keys[tile] not in cached]
+    if missing:
+        computed = _spatial_cluster_query(params, zoom, missing)
+        cache.set_many(dict((keys[tile], clusters) for tile, clusters in computed.items()), CACHE_7DAYS)
+        cached.update((keys[tile], clusters) for tile, clusters in computed.items())
+
+    clusters = []
+    for tile in tiles:
+        clusters += cached[keys[tile]]
+    return clusters
+
+
 # TODO:
 # this is a workaround for a leaflet bug; this should
 # be moved into the frontend rather than being in this
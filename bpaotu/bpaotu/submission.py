@@ -1,8 +1,11 @@
+import json
 import redis
 
 from django.conf import settings
 import logging
 
+from .query import metadata_uuid
+
 
 logger = logging.getLogger('rainbow')
 redis_client = redis.StrictRedis(host=settings.REDIS_HOST, db=settings.REDIS_DB)
@@ -30,3 +33,72 @@ class Submission:
     def __getattr__(self, name):
         value = redis_client.hget(self.submission_id.encode('utf8'), name.encode('utf8'))
         return None if value is None else value.decode('utf8')
+
+
+class SubmissionIndex:
+    """
+    the Galaxy dataset holding the BIOM export of a query, from a previous
+    submission, so an identical submission can copy the dataset rather than
+    regenerating and uploading it again.
+
+    keyed on the import UUID and the query's state_key, and also on the user:
+    a user's API key can only copy datasets from their own histories. entries
+    expire after settings.GALAXY_SUBMISSION_INDEX_TTL seconds.
+    """
+
+    @staticmethod
+    def _key(state_key, email):
+        return 'galaxy_submission_index:{}:{}:{}'.format(metadata_uuid(), state_key, email)
+
+    @classmethod
+    def get(cls, state_key, email):
+        "returns (history_id, dataset_id), or None"
+        value = redis_client.get(cls._key(state_key, email))
+        if value is None:
+            return None
+        entry = json.loads(value.decode('utf8'))
+        return entry['history_id'], entry['dataset_id']
+
+    @classmethod
+    def add(cls, state_key, email, history_id, dataset_id):
+        redis_client.set(
+            cls._key(state_key, email),
+            json.dumps({'history_id': history_id, 'dataset_id': dataset_id}),
+            ex=settings.GALAXY_SUBMISSION_INDEX_TTL)
+
+    @classmethod
+    def forget(cls, state_key, email):
+        redis_client.delete(cls._key(state_key, email))
+
+
+class PendingUploads:
+    """
+    the Galaxy uploads which are yet to finish, watched by the upload watcher
+    (see upload_watcher.py). stored as a sorted set of submission IDs, scored
+    by the time at which each upload should next be checked.
+    """
+
+    key = 'galaxy_pending_uploads'
+
+    @classmethod
+    def add(cls, submission_id, check_at):
+        redis_client.zadd(cls.key, {submission_id: check_at})
+
+    @classmethod
+    def reschedule(cls, submission_id, check_at):
+        # XX: only update if still pending, so a removal is never undone
+        redis_client.zadd(cls.key, {submission_id: check_at}, xx=True)
+
+    @classmethod
+    def remove(cls, submission_id):
+        redis_client.zrem(cls.key, submission_id)
+
+    @classmethod
+    def due(cls, now, limit):
+        return [t.decode('utf8') for t in redis_client.zrangebyscore(cls.key, '-inf', now, start=0, num=limit)]
+
+    @classmethod
+    def next_due(cls):
+        "the time at which the next upload is due to be checked, or None"
+        entries = redis_client.zrange(cls.key, 0, 0, withscores=True)
+        return entries[0][1] if entries else None
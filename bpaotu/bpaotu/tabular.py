@@ -1,4 +1,10 @@
-import zipstream
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
 from .otu import (
     OTUKingdom,
     SampleOTU,
@@ -11,6 +17,10 @@ from .util import (
 from .query import (
     OntologyInfo,
     SampleQuery)
+from .zipbuilder import (
+    file_chunks,
+    make_zip_builder,
+    make_zip_file)
 import io
 import csv
 import logging
@@ -19,6 +29,9 @@ from bpaingest.projects.amdb.contextual import AustralianMicrobiomeSampleContext
 
 logger = logging.getLogger('rainbow')
 
+# amount of uncompressed CSV data handed to the compressor at a time
+PARALLEL_BLOCK_SIZE = 1024 * 1024
+
 
 def _csv_write_function(column):
     def make_ontology_export(ontology_cls):
@@ -77,55 +90,122 @@ def contextual_csv(samples):
     return csv_fd.getvalue()
 
 
-def tabular_zip_file_generator(params):
-    zf = zipstream.ZipFile(mode='w', compression=zipstream.ZIP_DEFLATED)
+SAMPLE_OTU_CSV_HEADER = [
+    'Sample ID',
+    'OTU',
+    'OTU Count',
+    'Amplicon',
+    'Kingdom',
+    'Phylum',
+    'Class',
+    'Order',
+    'Family',
+    'Genus',
+    'Species']
+
+
+def sample_otu_csv_rows(query, kingdom_id):
+    fd = io.StringIO()
+    w = csv.writer(fd)
+    w.writerow(SAMPLE_OTU_CSV_HEADER)
+    yield fd.getvalue().encode('utf8')
+    fd.seek(0)
+    fd.truncate(0)
+    q = query.matching_sample_otus(OTU, SampleOTU, SampleContext, kingdom_id=kingdom_id)
+    for otu, sample_otu, sample_context in q.yield_per(50):
+        w.writerow([
+            format_sample_id(sample_otu.sample_id),
+            otu.code,
+            sample_otu.count,
+            val_or_empty(otu.amplicon),
+            val_or_empty(otu.kingdom),
+            val_or_empty(otu.phylum),
+            val_or_empty(otu.klass),
+            val_or_empty(otu.order),
+            val_or_empty(otu.family),
+            val_or_empty(otu.genus),
+            val_or_empty(otu.species)])
+        yield fd.getvalue().encode('utf8')
+        fd.seek(0)
+        fd.truncate(0)
+
+
+def tabular_zip_file_generator(params, compression=None):
+    if settings.EXPORT_PARALLEL_WORKERS > 0:
+        return parallel_tabular_zip_file_generator(params, settings.EXPORT_PARALLEL_WORKERS, compression)
+
+    zf = make_zip_file(compression)
     with SampleQuery(params) as query:
-        def sample_otu_csv_rows(kingdom_id):
-            fd = io.StringIO()
-            w = csv.writer(fd)
-            w.writerow([
-                'Sample ID',
-                'OTU',
-                'OTU Count',
-                'Amplicon',
-                'Kingdom',
-                'Phylum',
-                'Class',
-                'Order',
-                'Family',
-                'Genus',
-                'Species'])
-            yield fd.getvalue().encode('utf8')
-            fd.seek(0)
-            fd.truncate(0)
-            q = query.matching_sample_otus(OTU, SampleOTU, SampleContext, kingdom_id=kingdom_id)
-            for otu, sample_otu, sample_context in q.yield_per(50):
-                w.writerow([
-                    format_sample_id(sample_otu.sample_id),
-                    otu.code,
-                    sample_otu.count,
-                    val_or_empty(otu.amplicon),
-                    val_or_empty(otu.kingdom),
-                    val_or_empty(otu.phylum),
-                    val_or_empty(otu.klass),
-                    val_or_empty(otu.order),
-                    val_or_empty(otu.family),
-                    val_or_empty(otu.genus),
-                    val_or_empty(otu.species)])
-                yield fd.getvalue().encode('utf8')
-                fd.seek(0)
-                fd.truncate(0)
-
         zf.writestr('contextual.csv', contextual_csv(query.matching_samples()).encode('utf8'))
         zf.writestr('info.txt', info_text(params))
         with OntologyInfo() as info:
             for kingdom_id, kingdom_label in info.get_values(OTUKingdom):
                 if not query.has_matching_sample_otus(kingdom_id):
                     continue
-                zf.write_iter('%s.csv' % (kingdom_label), sample_otu_csv_rows(kingdom_id))
+                zf.write_iter('%s.csv' % (kingdom_label), sample_otu_csv_rows(query, kingdom_id))
         return zf
 
 
+class ExportCancelled(Exception):
+    pass
+
+
+def _render_kingdom_member(params, kingdom_id, path, compressor, cancelled):
+    """
+    render the CSV for a single kingdom, compressing into `path`. runs in a worker
+    thread, with its own database session. returns None if there are no matching
+    rows for the kingdom.
+    """
+    with SampleQuery(params) as query:
+        if not query.has_matching_sample_otus(kingdom_id):
+            return None
+        with open(path, 'wb') as fd:
+            buf = []
+            buf_size = 0
+            for chunk in sample_otu_csv_rows(query, kingdom_id):
+                buf.append(chunk)
+                buf_size += len(chunk)
+                if buf_size >= PARALLEL_BLOCK_SIZE:
+                    if cancelled.is_set():
+                        raise ExportCancelled()
+                    fd.write(compressor.compress(b''.join(buf)))
+                    buf = []
+                    buf_size = 0
+            fd.write(compressor.compress(b''.join(buf)))
+            fd.write(compressor.flush())
+    return compressor.member(file_chunks(path))
+
+
+def parallel_tabular_zip_file_generator(params, workers, compression=None):
+    """
+    as for tabular_zip_file_generator, but each kingdom's CSV is rendered and compressed
+    concurrently into a temporary file. the zip file is then assembled from those
+    temporary files, in order, as each becomes available.
+    """
+    zf = make_zip_builder(compression)
+    with SampleQuery(params) as query:
+        zf.writestr('contextual.csv', contextual_csv(query.matching_samples()).encode('utf8'))
+    zf.writestr('info.txt', info_text(params))
+    with OntologyInfo() as info:
+        kingdoms = info.get_values(OTUKingdom)
+
+    tempdir = tempfile.mkdtemp(dir=settings.WRITABLE_DIRECTORY, prefix='bpaotu-export-')
+    cancelled = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for kingdom_id, kingdom_label in kingdoms:
+            future = executor.submit(
+                _render_kingdom_member, params, kingdom_id, os.path.join(tempdir, '%d.csv' % kingdom_id),
+                zf.member_compressor(), cancelled)
+            zf.write_deferred('%s.csv' % (kingdom_label), future.result)
+        yield from zf
+    finally:
+        # if we've been closed early (e.g. the client went away) stop any work in progress
+        cancelled.set()
+        executor.shutdown(wait=True)
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
 def info_text(params):
     return """\
 Australian Microbiome OTU Database - tabular export
@@ -1,26 +1,25 @@
-from celery import shared_task
+from celery import chord, shared_task
 import logging
 import os
 import uuid
-import shutil
 import tempfile
+from functools import partial
 from django.conf import settings
 
 from .blast import BlastWrapper
-from .biom import save_biom_zip_file
-from .submission import Submission
+from .biom import biom_zip_file_generator
+from .export_cache import cached_export
+from .submission import Submission, SubmissionIndex
+from . import site_images
 from .galaxy_client import get_users_galaxy
+from .upload_watcher import watch_upload
+from .util import make_timestamp
 from . import views
 
 
 logger = logging.getLogger(__name__)
 
 
-# Should be None but using a large number because task retrying forever aren't much fun
-ALWAYS_RETRY = 1000
-
-FILE_UPLOAD_STATUS_POLL_FREQUENCY = 5
-
 # maximum length of a Galaxy history name
 GALAXY_HISTORY_NAME_MAX = 255
 
@@ -30,6 +29,17 @@ def debug_task(self):
     print('Request: {0!r}'.format(self.request))
 
 
+@shared_task
+def refresh_site_image_lookup_table():
+    site_images.refresh_site_image_lookup_table()
+    generate_site_image_thumbnails.delay()
+
+
+@shared_task
+def generate_site_image_thumbnails():
+    site_images.generate_thumbnails()
+
+
 @shared_task
 def submit_to_galaxy(email, query):
     submission_id = _create_submission_object(email, query)
@@ -41,8 +51,9 @@ def submit_to_galaxy(email, query):
 @shared_task
 def execute_workflow_on_galaxy(email, query, workflow_id):
     submission_id = _create_submission_object(email, query)
-    chain = upload_biom_to_history_chain | execute_workflow.s(workflow_id)
-    chain(submission_id)
+    # run by upload_finished, once the upload watcher sees the file is in Galaxy
+    Submission(submission_id).workflow_id = workflow_id
+    upload_biom_to_history_chain(submission_id)
 
     return submission_id
 
@@ -55,7 +66,7 @@ def submit_blast(search_string, query):
     submission.query = query
     submission.search_string = search_string
 
-    chain = setup_blast.s() | run_blast.s() | cleanup_blast.s()
+    chain = setup_blast.s() | run_blast.s()
 
     chain(submission_id)
 
@@ -63,23 +74,13 @@ def submit_blast(search_string, query):
 
 
 @shared_task
-def save_biom_file(submission_id):
+def upload_biom_to_history(submission_id):
     submission = Submission(submission_id)
 
     # The OTUQueryParam doesn't support JSON serialisation, so we use the query
     # submitted by the user which is a string and we parse it into a query again here.
     # At this point the params were already validated by the submit_to_galaxy view.
     params, _ = views.param_to_filters(submission.query)
-    biom_zip_file_name = save_biom_zip_file(params, tempfile.mkdtemp())
-    submission.biom_zip_file_name = biom_zip_file_name
-
-    return submission_id
-
-
-@shared_task
-def create_history_with_file(submission_id):
-    submission = Submission(submission_id)
-    full_file_name = submission.biom_zip_file_name
 
     galaxy = get_users_galaxy(submission.email)
     history = galaxy.histories.create(submission.name)
@@ -87,43 +88,60 @@ def create_history_with_file(submission_id):
     galaxy.histories.update(history)
     submission.history_id = history.get('id')
 
-    filename = os.path.split(full_file_name)[1]
-    file_id = galaxy.histories.upload_file(history.get('id'), full_file_name, filename, file_type='biom1')
+    file_id = _copy_previous_upload(galaxy, submission, params)
+    if file_id is not None:
+        submission.file_id = file_id
+        return submission_id
+
+    # the BIOM zip is streamed straight into the upload, as it is generated
+    # (or read back from the export cache), rather than via a temporary file
+    zf, timestamp = cached_export(
+        params, '.biom.zip', partial(biom_zip_file_generator, params), make_timestamp())
+    filename = params.filename(timestamp, '.biom.zip')
+    file_id = galaxy.histories.upload_stream(history.get('id'), zf, filename, file_type='biom1')
 
     submission.file_id = file_id
 
     return submission_id
 
 
-@shared_task(bind=True, max_retries=ALWAYS_RETRY)
-def check_upload_status(self, submission_id):
-    submission = Submission(submission_id)
-
-    galaxy = get_users_galaxy(submission.email)
-    state = galaxy.histories.get_file_state(submission.history_id, submission.file_id)
-    submission.upload_state = state
+def _copy_previous_upload(galaxy, submission, params):
+    """
+    if this user has already uploaded the BIOM for this query, copy that dataset
+    into the submission's history. returns the ID of the copy, or None
+    """
+    previous = SubmissionIndex.get(params.state_key, submission.email)
+    if previous is None:
+        return None
+    source_history_id, dataset_id = previous
+    try:
+        file_id = galaxy.histories.copy_dataset(submission.history_id, source_history_id, dataset_id)
+    except Exception:
+        logger.exception('unable to copy previously uploaded dataset: {}'.format(dataset_id))
+        file_id = None
+    if file_id is None:
+        SubmissionIndex.forget(params.state_key, submission.email)
+        return None
+    logger.info('reusing previously uploaded dataset: {} -> {}'.format(dataset_id, file_id))
+    return file_id
 
-    finished = state in ('ok', 'error')
-    if not finished:
-        self.retry(countdown=FILE_UPLOAD_STATUS_POLL_FREQUENCY)
 
+@shared_task
+def watch_upload_status(submission_id):
+    # the upload watcher (management command galaxy_upload_watcher) tracks the
+    # upload from here, and queues upload_finished when it completes
+    watch_upload(submission_id)
     return submission_id
 
 
 @shared_task
-def delete_biom_file(submission_id):
+def upload_finished(submission_id):
     submission = Submission(submission_id)
-    biom_file_name = submission.biom_zip_file_name
-
-    if not os.path.exists(biom_file_name):
-        logger.warning("Trying to delete biom file '%s', but it doesn't exist.", biom_file_name)
-        return submission_id
-    dir_name = os.path.split(biom_file_name)[0]
-    try:
-        shutil.rmtree(dir_name)
-    except Exception:
-        logger.exception('Error when deleting biom zip file (%s)' % biom_file_name)
-
+    if submission.upload_state == 'ok':
+        params, _ = views.param_to_filters(submission.query)
+        SubmissionIndex.add(params.state_key, submission.email, submission.history_id, submission.file_id)
+    if submission.workflow_id and submission.upload_state == 'ok':
+        execute_workflow(submission_id, submission.workflow_id)
     return submission_id
 
 
@@ -138,24 +156,53 @@ def execute_workflow(submission_id, workflow_id):
 
 
 upload_biom_to_history_chain = (
-    save_biom_file.s() | create_history_with_file.s() | check_upload_status.s() | delete_biom_file.s())
+    upload_biom_to_history.s() | watch_upload_status.s())
 
 
 @shared_task
 def setup_blast(submission_id):
     submission = Submission(submission_id)
-    submission.cwd = tempfile.mkdtemp()
+    # the working directory must be visible to every worker that runs a shard
+    os.makedirs(settings.BLAST_WORKING_PATH, exist_ok=True)
+    submission.cwd = tempfile.mkdtemp(dir=settings.BLAST_WORKING_PATH)
     wrapper = _make_blast_wrapper(submission)
-    wrapper.setup()
+    submission.shards = wrapper.setup()
     return submission_id
 
 
 @shared_task
 def run_blast(submission_id):
+    """
+    search each shard of the OTU database in its own task, in parallel, then
+    merge the results
+    """
+    submission = Submission(submission_id)
+    shards = int(submission.shards)
+    merge = merge_blast_results.si(submission_id, shards).on_error(cleanup_blast.si(submission_id))
+    if shards == 0:
+        merge.delay()
+    else:
+        chord(run_blast_shard.si(submission_id, shard) for shard in range(shards))(merge)
+    return submission_id
+
+
+@shared_task
+def run_blast_shard(submission_id, shard):
+    submission = Submission(submission_id)
+    wrapper = _make_blast_wrapper(submission)
+    wrapper.run_shard(shard)
+    return shard
+
+
+@shared_task
+def merge_blast_results(submission_id, shards):
     submission = Submission(submission_id)
     wrapper = _make_blast_wrapper(submission)
-    fname = wrapper.run()
-    submission.result_url = settings.BLAST_RESULTS_URL + '/' + fname
+    try:
+        fname = wrapper.merge(shards)
+        submission.result_url = settings.BLAST_RESULTS_URL + '/' + fname
+    finally:
+        wrapper.cleanup()
     return submission_id
 
 
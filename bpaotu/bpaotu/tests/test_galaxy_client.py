@@ -0,0 +1,34 @@
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from ..galaxy_client import GalaxyAuthError, GalaxyClient
+
+
+def response(status_code, body=None):
+    return mock.Mock(status_code=status_code, text='error text', json=mock.Mock(return_value=body))
+
+
+class GalaxyClientResponseTest(SimpleTestCase):
+    def setUp(self):
+        self.on_auth_error = mock.Mock()
+        with mock.patch('bpaotu.galaxy_client.get_session'):
+            self.client = GalaxyClient('http://galaxy.test/', 'key', on_auth_error=self.on_auth_error)
+
+    def test_ok(self):
+        self.client.session.get.return_value = response(200, {'id': 'abc'})
+        self.assertEqual(self.client.get('users'), {'id': 'abc'})
+        self.on_auth_error.assert_not_called()
+
+    def test_server_error(self):
+        self.client.session.post.return_value = response(500)
+        with self.assertRaisesMessage(Exception, 'Galaxy Error: error text') as cm:
+            self.client.post('histories', name='test')
+        self.assertNotIsInstance(cm.exception, GalaxyAuthError)
+        self.on_auth_error.assert_not_called()
+
+    def test_auth_error(self):
+        self.client.session.put.return_value = response(401)
+        with self.assertRaises(GalaxyAuthError):
+            self.client.put('users/abc', {})
+        self.on_auth_error.assert_called_once_with()
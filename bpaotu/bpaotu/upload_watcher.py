@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from .galaxy_client import get_users_galaxy
+from .submission import PendingUploads, Submission
+
+logger = logging.getLogger("rainbow")
+
+
+# adaptive backoff: an upload is checked again after MIN_POLL_INTERVAL seconds,
+# growing by BACKOFF_FACTOR each time its state is unchanged, up to MAX_POLL_INTERVAL
+MIN_POLL_INTERVAL = 2.0
+MAX_POLL_INTERVAL = 60.0
+BACKOFF_FACTOR = 1.5
+# the watcher wakes at least this often to look for newly registered uploads
+IDLE_INTERVAL = 1.0
+FINISHED_STATES = ('ok', 'error')
+
+
+def watch_upload(submission_id):
+    """
+    register a Galaxy upload with the watcher. once the upload has finished,
+    the watcher records the final state and queues `tasks.upload_finished`
+    """
+    submission = Submission(submission_id)
+    submission.upload_watch_started = time.time()
+    submission.upload_poll_interval = MIN_POLL_INTERVAL
+    PendingUploads.add(submission_id, time.time() + MIN_POLL_INTERVAL)
+
+
+class UploadWatcher:
+    """
+    a single long-running process which checks the state of all pending Galaxy
+    uploads. the blocking HTTP calls are made from a small thread pool, over the
+    shared, pooled HTTP session; the number of uploads in flight doesn't affect
+    the number of Celery workers occupied or the broker traffic.
+    """
+
+    def __init__(self, concurrency=None, timeout=None):
+        self._concurrency = concurrency or settings.GALAXY_UPLOAD_WATCHER_CONCURRENCY
+        self._timeout = timeout or settings.GALAXY_UPLOAD_WATCH_TIMEOUT
+        self._executor = ThreadPoolExecutor(max_workers=self._concurrency)
+        # created within run(), as it must belong to the running event loop
+        self._stopping = None
+
+    def stop(self):
+        if self._stopping is not None:
+            self._stopping.set()
+
+    def _get_state(self, submission):
+        galaxy = get_users_galaxy(submission.email)
+        return galaxy.histories.get_file_state(submission.history_id, submission.file_id)
+
+    def _finish(self, submission_id, state):
+        # avoid a circular import: tasks imports the views
+        from .tasks import upload_finished
+
+        submission = Submission(submission_id)
+        submission.upload_state = state
+        PendingUploads.remove(submission_id)
+        upload_finished.delay(submission_id)
+        logger.info('galaxy upload finished: {} ({})'.format(submission_id, state))
+
+    def _check(self, submission_id):
+        submission = Submission(submission_id)
+        now = time.time()
+        started = float(submission.upload_watch_started or now)
+        if now - started > self._timeout:
+            logger.error('galaxy upload timed out: {}'.format(submission_id))
+            self._finish(submission_id, 'error')
+            return
+
+        interval = float(submission.upload_poll_interval or MIN_POLL_INTERVAL)
+        try:
+            state = self._get_state(submission)
+        except Exception:
+            logger.exception('unable to check galaxy upload state: {}'.format(submission_id))
+            state = None
+
+        if state in FINISHED_STATES:
+            self._finish(submission_id, state)
+            return
+        if state is not None and state != submission.upload_state:
+            # progress: check again soon
+            submission.upload_state = state
+            interval = MIN_POLL_INTERVAL
+        else:
+            interval = min(interval * BACKOFF_FACTOR, MAX_POLL_INTERVAL)
+        submission.upload_poll_interval = interval
+        PendingUploads.reschedule(submission_id, time.time() + interval)
+
+    async def _check_due(self, loop):
+        due = await loop.run_in_executor(
+            self._executor, PendingUploads.due, time.time(), self._concurrency)
+        await asyncio.gather(
+            *(loop.run_in_executor(self._executor, self._check, submission_id) for submission_id in due))
+        return len(due)
+
+    async def _sleep(self, loop):
+        next_due = await loop.run_in_executor(self._executor, PendingUploads.next_due)
+        delay = IDLE_INTERVAL
+        if next_due is not None:
+            delay = max(0, min(next_due - time.time(), IDLE_INTERVAL))
+        try:
+            await asyncio.wait_for(self._stopping.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        self._stopping = asyncio.Event()
+        logger.info('galaxy upload watcher started')
+        while not self._stopping.is_set():
+            try:
+                checked = await self._check_due(loop)
+            except Exception:
+                # e.g. redis unavailable: keep going
+                logger.exception('galaxy upload watcher: error checking uploads')
+                checked = 0
+            # if we were at our concurrency limit, there may be more due
+            if checked < self._concurrency:
+                await self._sleep(loop)
+        self._executor.shutdown()
+        logger.info('galaxy upload watcher stopped')
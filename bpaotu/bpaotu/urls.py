@@ -14,6 +14,12 @@ urlpatterns = [
     url(r'^private/api/v1/nondenoised-request$', views.nondenoised_request, name="nondenoised_request"),
     url(r'^private/api/v1/search$', views.otu_search, name="otu_search"),
     url(r'^private/api/v1/search-sample-sites$', views.otu_search_sample_sites, name="otu_search_sample_sites"),
+    url(r'^private/api/v1/sample-site-details$', views.sample_site_details, name="sample_site_details"),
+    url(r'^private/api/v1/sequence-search$', views.otu_sequence_search, name="otu_sequence_search"),
+    url(
+        r'^private/api/v1/search-sample-clusters$',
+        views.otu_search_sample_clusters,
+        name="otu_search_sample_clusters"),
     url(r'^private/api/v1/submit_to_galaxy$', views.submit_to_galaxy, name="submit_to_galaxy"),
     url(
         r'^private/api/v1/execute_workflow_on_galaxy$',
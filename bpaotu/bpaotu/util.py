@@ -52,6 +52,13 @@ def make_timestamp():
     return datetime.datetime.now().replace(microsecond=0).isoformat().replace(':', '')
 
 
+def parse_timestamp(timestamp):
+    """
+    inverse of make_timestamp()
+    """
+    return datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H%M%S')
+
+
 def parse_date(s):
     try:
         return datetime.datetime.strptime(s, '%Y-%m-%d').date()
@@ -1,4 +1,5 @@
 import csv
+import datetime
 import hmac
 import io
 import json
@@ -7,37 +8,45 @@ import os
 import re
 import time
 from collections import OrderedDict, defaultdict
-from functools import wraps
+from functools import partial, wraps
 from operator import itemgetter
 
 from bpaingest.projects.amdb.contextual import \
     AustralianMicrobiomeSampleContextual
 from django.conf import settings
 from django.core.mail import send_mail
-from django.http import (Http404, HttpResponse, JsonResponse,
+from django.http import (FileResponse, Http404, HttpResponse, JsonResponse,
                          StreamingHttpResponse)
 from django.template import loader
 from django.urls import reverse
-from django.views.decorators.cache import cache_page
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date, quote_etag
 from django.views.decorators.csrf import ensure_csrf_cookie
-from django.views.decorators.http import require_GET, require_POST
+from django.views.decorators.http import condition, require_GET, require_POST
 
 from . import tasks
 from .biom import biom_zip_file_generator
 from .ckan_auth import require_CKAN_auth
+from .export_cache import cached_export
 from .galaxy_client import galaxy_ensure_user, get_krona_workflow
 from .importer import DataImporter
+from .kmer_index import KmerIndexError, sequence_search
 from .models import NonDenoisedDataRequest
 from .otu import Environment, OTUAmplicon, SampleContext
 from .query import (ContextualFilter, ContextualFilterTermDate,
                     ContextualFilterTermFloat, ContextualFilterTermOntology,
                     ContextualFilterTermSampleID, ContextualFilterTermString,
                     MetadataInfo, OntologyInfo, OTUQueryParams, SampleQuery,
-                    TaxonomyFilter, TaxonomyOptions, get_sample_ids)
-from .site_images import fetch_image, get_site_image_lookup_table
-from .spatial import spatial_query
+                    TaxonomyFilter, TaxonomyOptions, get_sample_ids,
+                    metadata_uuid)
+from .site_images import (THUMBNAIL_SIZE, THUMBNAIL_SIZES, get_site_image_lookup_table,
+                          get_thumbnail, thumbnail_path)
+from .spatial import (SpatialError, spatial_abundance_query,
+                      spatial_cluster_query, spatial_query,
+                      spatial_sample_details, spatial_site_query)
 from .tabular import tabular_zip_file_generator
 from .util import make_timestamp, parse_date, parse_float
+from .zipbuilder import compression_variant, parse_compression
 
 logger = logging.getLogger("rainbow")
 
@@ -123,6 +132,9 @@ def api_config(request):
         'submit_blast_endpoint': reverse('submit_blast'),
         'blast_submission_endpoint': reverse('blast_submission'),
         'search_sample_sites_endpoint': reverse('otu_search_sample_sites'),
+        'sample_site_details_endpoint': reverse('sample_site_details'),
+        'search_sample_clusters_endpoint': reverse('otu_search_sample_clusters'),
+        'sequence_search_endpoint': reverse('otu_sequence_search'),
         'required_table_headers_endpoint': reverse('required_table_headers'),
         'contextual_csv_download_endpoint': reverse('contextual_csv_download_endpoint'),
         'base_url': settings.BASE_URL,
@@ -368,13 +380,26 @@ def nondenoised_request(request):
 @require_CKAN_auth
 @require_POST
 def otu_search_sample_sites(request):
+    """
+    private API: the sample sites matching the query. if `mode` is 'lean', only
+    the location and matching sample IDs of each site are returned: the contextual
+    data for a site may then be retrieved using `sample_site_details`. if `mode` is
+    'abundance', the OTU count and relative abundance of the selected taxonomy at
+    each site are returned
+    """
     params, errors = param_to_filters(request.POST['otu_query'])
     if errors:
         return JsonResponse({
             'errors': [str(e) for e in errors],
             'data': [],
         })
-    data = spatial_query(params)
+    mode = request.POST.get('mode')
+    if mode == 'lean':
+        data = spatial_site_query(params)
+    elif mode == 'abundance':
+        data = spatial_abundance_query(params)
+    else:
+        data = spatial_query(params)
 
     site_image_lookup_table = get_site_image_lookup_table()
 
@@ -384,6 +409,86 @@ def otu_search_sample_sites(request):
     return JsonResponse({'data': data})
 
 
+SEQUENCE_SEARCH_MAX_RESULTS = 500
+
+
+@require_CKAN_auth
+@require_POST
+def otu_sequence_search(request):
+    """
+    private API: the OTUs matching the query whose codes are most similar to
+    `sequence`, found using the k-mer index (no BLAST job is queued.) at most
+    `limit` results are returned.
+    """
+    params, errors = param_to_filters(request.POST['otu_query'])
+    sequence = re.sub(r'\s', '', request.POST.get('sequence', '')).upper()
+    if not re.match(r'^[ACGTN]+$', sequence):
+        errors.append('Invalid sequence: must contain only A, C, G, T or N')
+    try:
+        limit = min(int(request.POST.get('limit', 50)), SEQUENCE_SEARCH_MAX_RESULTS)
+        if limit < 1:
+            raise ValueError()
+    except ValueError:
+        errors.append('Invalid limit')
+    if errors:
+        return JsonResponse({
+            'errors': [str(e) for e in errors],
+            'data': [],
+        })
+    try:
+        data = sequence_search(params, metadata_uuid(), sequence, limit)
+    except KmerIndexError as e:
+        return JsonResponse({
+            'errors': [str(e)],
+            'data': [],
+        })
+    return JsonResponse({'data': data})
+
+
+@require_CKAN_auth
+@require_POST
+def otu_search_sample_clusters(request):
+    """
+    private API: clusters of the sample sites matching the query, within the
+    map bounds `bounds` ([south, west, north, east]) at zoom level `zoom`
+    """
+    params, errors = param_to_filters(request.POST['otu_query'])
+    try:
+        south, west, north, east = [float(t) for t in json.loads(request.POST['bounds'])]
+        zoom = int(request.POST['zoom'])
+    except (KeyError, TypeError, ValueError):
+        errors.append('Invalid map bounds or zoom')
+    if errors:
+        return JsonResponse({
+            'errors': [str(e) for e in errors],
+            'data': [],
+        })
+    try:
+        data = spatial_cluster_query(params, (south, west, north, east), zoom)
+    except SpatialError as e:
+        return JsonResponse({
+            'errors': [str(e)],
+            'data': [],
+        })
+    return JsonResponse({'data': data})
+
+
+@require_CKAN_auth
+@require_POST
+def sample_site_details(request):
+    """
+    private API: the contextual data for the given sample IDs
+    """
+    try:
+        sample_ids = [int(t) for t in json.loads(request.POST['sample_ids'])]
+    except (KeyError, TypeError, ValueError):
+        return JsonResponse({
+            'errors': ['Invalid sample IDs'],
+            'data': {},
+        })
+    return JsonResponse({'data': spatial_sample_details(sample_ids)})
+
+
 # technically we should be using GET, but the specification
 # of the query (plus the datatables params) is large: so we
 # avoid the issues of long URLs by simply POSTing the query
@@ -440,12 +545,27 @@ def otu_search(request, contextual_filtering=True):
     })
 
 
+def clean_compression(v):
+    """
+    the compression level requested for an export, or None for the default
+    """
+    if not v:
+        return None
+    try:
+        parse_compression(v)
+    except ValueError:
+        return None
+    return str(v).strip().lower()
+
+
 @require_CKAN_auth
 @require_GET
 def otu_biom_export(request):
-    timestamp = make_timestamp()
     params, errors = param_to_filters(request.GET['q'])
-    zf = biom_zip_file_generator(params, timestamp)
+    compression = clean_compression(request.GET.get('compression'))
+    zf, timestamp = cached_export(
+        params, '.biom.zip', partial(biom_zip_file_generator, params, compression=compression),
+        make_timestamp(), variant=compression_variant(compression))
     response = StreamingHttpResponse(zf, content_type='application/zip')
     filename = params.filename(timestamp, '.biom.zip')
     response['Content-Disposition'] = 'attachment; filename="%s"' % filename
@@ -459,13 +579,16 @@ def otu_export(request):
     this view takes:
      - contextual filters
      - taxonomic filters
+     - optionally, a compression level ('store', or 1-9)
     produces a Zip file containing:
       - an CSV of all the contextual data samples matching the query
       - an CSV of all the OTUs matching the query, with counts against Sample IDs
     """
-    timestamp = make_timestamp()
     params, errors = param_to_filters(request.GET['q'])
-    zf = tabular_zip_file_generator(params)
+    compression = clean_compression(request.GET.get('compression'))
+    zf, timestamp = cached_export(
+        params, '-csv.zip', lambda timestamp: tabular_zip_file_generator(params, compression),
+        make_timestamp(), variant=compression_variant(compression))
     response = StreamingHttpResponse(zf, content_type='application/zip')
     filename = params.filename(timestamp, '-csv.zip')
     response['Content-Disposition'] = 'attachment; filename="%s"' % filename
@@ -699,11 +822,63 @@ def dev_only_ckan_check_permissions(request):
     return HttpResponse(response)
 
 
-@cache_page(CACHE_1DAY, cache="image_results")
+def _thumbnail_size(request):
+    try:
+        size = int(request.GET.get('size', THUMBNAIL_SIZE))
+    except ValueError:
+        raise Http404()
+    if size not in THUMBNAIL_SIZES:
+        raise Http404()
+    return size
+
+
+def _thumbnail_stat(request, resource_id):
+    try:
+        return os.stat(thumbnail_path(resource_id, _thumbnail_size(request)))
+    except FileNotFoundError:
+        return None
+
+
+def _thumbnail_etag_value(resource_id, st):
+    return '{}-{}-{}'.format(resource_id, int(st.st_mtime), st.st_size)
+
+
+def _thumbnail_etag(request, package_id, resource_id):
+    st = _thumbnail_stat(request, resource_id)
+    if st is None:
+        return None
+    return _thumbnail_etag_value(resource_id, st)
+
+
+def _thumbnail_last_modified(request, package_id, resource_id):
+    st = _thumbnail_stat(request, resource_id)
+    if st is None:
+        return None
+    return datetime.datetime.utcfromtimestamp(st.st_mtime)
+
+
+@condition(etag_func=_thumbnail_etag, last_modified_func=_thumbnail_last_modified)
 def site_image_thumbnail(request, package_id, resource_id):
     '''
-    Return specified cached image or fetch image from ckan and resize before caching and returning.
-    '''
+    Return the thumbnail of the specified image, from the thumbnail store. Thumbnails
+    are pre-generated in the background; if missing, the thumbnail is rendered on demand.
 
-    buf, content_type = fetch_image(package_id, resource_id)
-    return HttpResponse(buf.getvalue(), content_type=content_type)
+    `size` may be given in the query string, and must be one of THUMBNAIL_SIZES.
+    '''
+    path = get_thumbnail(package_id, resource_id, _thumbnail_size(request))
+    sendfile = settings.SITE_IMAGE_THUMBNAIL_SENDFILE
+    if sendfile == 'x-sendfile':
+        response = HttpResponse(content_type='image/jpeg')
+        response['X-Sendfile'] = path
+    elif sendfile == 'x-accel-redirect':
+        response = HttpResponse(content_type='image/jpeg')
+        response['X-Accel-Redirect'] = settings.SITE_IMAGE_THUMBNAIL_ACCEL_PREFIX + \
+            os.path.relpath(path, settings.SITE_IMAGE_THUMBNAIL_PATH)
+    else:
+        response = FileResponse(open(path, 'rb'), content_type='image/jpeg')
+    # set here as well as by @condition, which can't if the thumbnail was rendered on demand
+    st = os.stat(path)
+    response['ETag'] = quote_etag(_thumbnail_etag_value(resource_id, st))
+    response['Last-Modified'] = http_date(st.st_mtime)
+    patch_cache_control(response, private=True, max_age=CACHE_1DAY)
+    return response
@@ -0,0 +1,384 @@
+import struct
+import threading
+import time
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import zipstream
+from django.conf import settings
+
+#
+# A minimal streaming zip writer. It supports:
+#  - members whose compressed data has been produced ahead of time (for example,
+#    rendered in parallel into temporary files.) As the CRC and sizes are known
+#    before these members are written, no data descriptors are required.
+#  - members streamed from an iterable, deflated in parallel blocks across a
+#    thread pool (in the style of pigz), followed by a data descriptor.
+# Zip64 extensions are used where needed.
+#
+# Exports obtain a zip file via make_zip_file(), which selects between this
+# writer and zipstream according to settings.EXPORT_COMPRESSION_BACKEND
+#
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+# parallel deflate: the input is split into blocks of this size, each block
+# is compressed independently, primed with the preceding 32KiB of input
+DEFLATE_BLOCK_SIZE = 128 * 1024
+DEFLATE_DICT_SIZE = 32 * 1024
+
+COMPRESSION_STORE = 'store'
+
+
+class PrecompressedMember:
+    def __init__(self, compress_type, crc, compress_size, file_size, chunks):
+        self.compress_type = compress_type
+        self.crc = crc
+        self.compress_size = compress_size
+        self.file_size = file_size
+        self.chunks = chunks
+
+
+class MemberCompressor:
+    """
+    accumulates the CRC, sizes and compressed data of a member
+    """
+
+    def __init__(self, compress_type=zipfile.ZIP_DEFLATED, compresslevel=zlib.Z_DEFAULT_COMPRESSION):
+        self.compress_type = compress_type
+        self.crc = 0
+        self.compress_size = 0
+        self.file_size = 0
+        self._compressor = None
+        if compress_type == zipfile.ZIP_DEFLATED:
+            self._compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+
+    def compress(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.file_size += len(data)
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        self.compress_size += len(data)
+        return data
+
+    def flush(self):
+        if self._compressor is None:
+            return b''
+        data = self._compressor.flush()
+        self.compress_size += len(data)
+        return data
+
+    def member(self, chunks):
+        return PrecompressedMember(self.compress_type, self.crc, self.compress_size, self.file_size, chunks)
+
+
+def file_chunks(path):
+    with open(path, 'rb') as fd:
+        while True:
+            data = fd.read(READ_CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+
+
+def parse_compression(compression):
+    """
+    returns (compress_type, compresslevel) for a compression setting, which is
+    either 'store' (no compression), or a deflate level from 0 to 9. level 0 is
+    treated as 'store'.
+    """
+    compression = str(compression).strip().lower()
+    if compression == COMPRESSION_STORE or compression == '0':
+        return zipfile.ZIP_STORED, None
+    level = int(compression)
+    if level < 1 or level > 9:
+        raise ValueError("invalid compression level: {}".format(compression))
+    return zipfile.ZIP_DEFLATED, level
+
+
+def _deflate_block(data, zdict, compresslevel, last):
+    if zdict:
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    # a sync flush byte-aligns the output, so that the compressed blocks may
+    # simply be concatenated to form a single raw deflate stream
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def _blocks(chunks, block_size):
+    "re-chunk `chunks` into blocks of `block_size`, yields (block, is_last_block)"
+    buf = bytearray()
+    pending = None
+    for chunk in chunks:
+        buf += chunk
+        while len(buf) >= block_size:
+            if pending is not None:
+                yield pending, False
+            pending = bytes(buf[:block_size])
+            del buf[:block_size]
+    if buf:
+        if pending is not None:
+            yield pending, False
+        pending = bytes(buf)
+    yield (pending or b''), True
+
+
+def parallel_deflate(blocks, executor, compresslevel, window):
+    """
+    deflate `blocks` (as produced by _blocks) using `executor`. zlib releases the
+    GIL while compressing, so blocks are compressed concurrently. at most `window`
+    blocks are in flight at any time, bounding memory use.
+    """
+    pending = deque()
+    zdict = None
+    for block, last in blocks:
+        pending.append(executor.submit(_deflate_block, block, zdict, compresslevel, last))
+        zdict = block[-DEFLATE_DICT_SIZE:]
+        while len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _encode_filename(zinfo):
+    try:
+        return zinfo.filename.encode('ascii'), zinfo.flag_bits
+    except UnicodeEncodeError:
+        return zinfo.filename.encode('utf-8'), zinfo.flag_bits | 0x800
+
+
+def _dos_date_time(date_time):
+    dosdate = (date_time[0] - 1980) << 9 | date_time[1] << 5 | date_time[2]
+    dostime = date_time[3] << 11 | date_time[4] << 5 | (date_time[5] // 2)
+    return dosdate, dostime
+
+
+class ZipBuilder:
+    """
+    iterating over a ZipBuilder yields the bytes of the zip file. members are
+    resolved lazily, in order, as the zip file is iterated over.
+    """
+
+    def __init__(self, compress_type=zipfile.ZIP_DEFLATED, compresslevel=zlib.Z_DEFAULT_COMPRESSION,
+                 executor=None, window=None):
+        """
+        if `executor` is provided, streamed members are deflated in parallel
+        blocks using it, with at most `window` blocks in flight
+        """
+        self.compress_type = compress_type
+        self.compresslevel = compresslevel
+        self._executor = executor
+        self._window = window or 1
+        self._members = []
+        self._infos = []
+        self._offset = 0
+
+    def member_compressor(self):
+        "a MemberCompressor using this zip file's compression settings"
+        if self.compress_type == zipfile.ZIP_STORED:
+            return MemberCompressor(compress_type=zipfile.ZIP_STORED)
+        return MemberCompressor(compress_type=self.compress_type, compresslevel=self.compresslevel)
+
+    def writestr(self, arcname, data):
+        compressor = self.member_compressor()
+        compressed = compressor.compress(data) + compressor.flush()
+        member = compressor.member([compressed])
+        self.write_deferred(arcname, lambda: member)
+
+    def write_deferred(self, arcname, member_fn):
+        """
+        `member_fn` will be called when this member is to be written, and must
+        return a PrecompressedMember, or None if the member is to be skipped
+        """
+        def _write():
+            member = member_fn()
+            if member is not None:
+                yield from self._write_member(arcname, member)
+        self._members.append(_write)
+
+    def write_iter(self, arcname, iterable):
+        """
+        stream a member from `iterable`, which must yield bytes
+        """
+        self._members.append(lambda: self._write_streamed(arcname, iterable))
+
+    def _yield(self, data):
+        self._offset += len(data)
+        return data
+
+    def _zinfo(self, arcname, compress_type):
+        zinfo = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+        zinfo.external_attr = 0o600 << 16
+        zinfo.compress_type = compress_type
+        zinfo.header_offset = self._offset
+        return zinfo
+
+    def _write_member(self, arcname, member):
+        zinfo = self._zinfo(arcname, member.compress_type)
+        zinfo.CRC = member.crc
+        zinfo.compress_size = member.compress_size
+        zinfo.file_size = member.file_size
+        zip64 = member.file_size > zipfile.ZIP64_LIMIT or member.compress_size > zipfile.ZIP64_LIMIT
+        yield self._yield(zinfo.FileHeader(zip64))
+        for chunk in member.chunks:
+            yield self._yield(chunk)
+        self._infos.append(zinfo)
+
+    def _compressed_blocks(self, blocks):
+        if self.compress_type == zipfile.ZIP_STORED:
+            return (block for block, _ in blocks)
+        if self._executor is None:
+            return self._serial_deflate(blocks)
+        return parallel_deflate(blocks, self._executor, self.compresslevel, self._window)
+
+    def _serial_deflate(self, blocks):
+        compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -15)
+        for block, _ in blocks:
+            yield compressor.compress(block)
+        yield compressor.flush()
+
+    def _write_streamed(self, arcname, iterable):
+        zinfo = self._zinfo(arcname, self.compress_type)
+        # sizes and CRC follow the data, in a data descriptor. as the size is
+        # not known in advance, always use zip64 sizes.
+        zinfo.flag_bits |= 0x08
+        zinfo.extract_version = max(zinfo.extract_version, zipfile.ZIP64_VERSION)
+        yield self._yield(zinfo.FileHeader(zip64=True))
+
+        crc = 0
+        file_size = 0
+
+        def _checksummed(blocks):
+            nonlocal crc, file_size
+            for block, last in blocks:
+                crc = zlib.crc32(block, crc)
+                file_size += len(block)
+                yield block, last
+
+        compress_size = 0
+        for data in self._compressed_blocks(_checksummed(_blocks(iterable, DEFLATE_BLOCK_SIZE))):
+            compress_size += len(data)
+            yield self._yield(data)
+
+        zinfo.CRC = crc
+        zinfo.compress_size = compress_size
+        zinfo.file_size = file_size
+        yield self._yield(struct.pack('<4sLQQ', b'PK\x07\x08', crc, compress_size, file_size))
+        self._infos.append(zinfo)
+
+    def _central_directory(self):
+        for zinfo in self._infos:
+            dosdate, dostime = _dos_date_time(zinfo.date_time)
+            extra = []
+            if zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT:
+                extra += [zinfo.file_size, zinfo.compress_size]
+                file_size = compress_size = 0xffffffff
+            else:
+                file_size, compress_size = zinfo.file_size, zinfo.compress_size
+            header_offset = zinfo.header_offset
+            if header_offset > zipfile.ZIP64_LIMIT:
+                extra.append(header_offset)
+                header_offset = 0xffffffff
+            extra_data = zinfo.extra
+            min_version = 0
+            if extra:
+                extra_data = struct.pack('<HH' + 'Q' * len(extra), 1, 8 * len(extra), *extra) + extra_data
+                min_version = zipfile.ZIP64_VERSION
+            filename, flag_bits = _encode_filename(zinfo)
+            centdir = struct.pack(
+                zipfile.structCentralDir, zipfile.stringCentralDir,
+                max(min_version, zinfo.create_version), zinfo.create_system,
+                max(min_version, zinfo.extract_version), zinfo.reserved,
+                flag_bits, zinfo.compress_type, dostime, dosdate, zinfo.CRC,
+                compress_size, file_size, len(filename), len(extra_data), len(zinfo.comment),
+                0, zinfo.internal_attr, zinfo.external_attr, header_offset)
+            yield self._yield(centdir + filename + extra_data + zinfo.comment)
+
+    def _end_record(self, centdir_offset):
+        count = len(self._infos)
+        centdir_size = self._offset - centdir_offset
+        if (count > zipfile.ZIP_FILECOUNT_LIMIT or
+                centdir_offset > zipfile.ZIP64_LIMIT or centdir_size > zipfile.ZIP64_LIMIT):
+            zip64_end = struct.pack(
+                zipfile.structEndArchive64, zipfile.stringEndArchive64,
+                44, 45, 45, 0, 0, count, count, centdir_size, centdir_offset)
+            zip64_locator = struct.pack(
+                zipfile.structEndArchive64Locator, zipfile.stringEndArchive64Locator,
+                0, self._offset, 1)
+            yield self._yield(zip64_end + zip64_locator)
+            count = min(count, 0xffff)
+            centdir_size = min(centdir_size, 0xffffffff)
+            centdir_offset = min(centdir_offset, 0xffffffff)
+        yield self._yield(struct.pack(
+            zipfile.structEndArchive, zipfile.stringEndArchive,
+            0, 0, count, count, centdir_size, centdir_offset, 0))
+
+    def __iter__(self):
+        for write_member in self._members:
+            yield from write_member()
+        centdir_offset = self._offset
+        yield from self._central_directory()
+        yield from self._end_record(centdir_offset)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def compression_executor():
+    "a thread pool shared by all exports within this process, for parallel deflate"
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.EXPORT_COMPRESSION_THREADS, thread_name_prefix='deflate')
+    return _executor
+
+
+def make_zip_builder(compression=None):
+    compress_type, compresslevel = parse_compression(compression or settings.EXPORT_COMPRESSION_LEVEL)
+    threads = settings.EXPORT_COMPRESSION_THREADS
+    executor = None
+    if compress_type == zipfile.ZIP_DEFLATED and threads > 1:
+        executor = compression_executor()
+    return ZipBuilder(
+        compress_type=compress_type, compresslevel=compresslevel, executor=executor, window=threads * 2)
+
+
+def make_zip_file(compression=None):
+    """
+    returns a streaming zip file for an export, using the configured compression
+    backend. `compression` overrides the default level (see parse_compression)
+
+    the returned object supports writestr(), write_iter(), and iterating over it
+    yields the zip file data
+    """
+    if settings.EXPORT_COMPRESSION_BACKEND == 'parallel':
+        return make_zip_builder(compression)
+    # note: zipstream does not support setting the deflate level
+    compress_type, _ = parse_compression(compression or settings.EXPORT_COMPRESSION_LEVEL)
+    return zipstream.ZipFile(mode='w', compression=compress_type)
+
+
+def compression_variant(compression=None):
+    """
+    distinguishes, for the export cache, the archives make_zip_file(compression)
+    produces: None if it is the same as with the default compression. as
+    zipstream ignores the deflate level, only the choice of storing or
+    deflating matters for that backend.
+    """
+    if not compression:
+        return None
+    requested = parse_compression(compression)
+    default = parse_compression(settings.EXPORT_COMPRESSION_LEVEL)
+    if settings.EXPORT_COMPRESSION_BACKEND != 'parallel':
+        requested, default = requested[0], default[0]
+        if requested == default:
+            return None
+        return COMPRESSION_STORE if requested == zipfile.ZIP_STORED else 'deflate'
+    if requested == default:
+        return None
+    return compression
@@ -242,6 +242,22 @@ if [ "$1" = 'celery_worker' ]; then
     exec celery -A bpaotu worker -l info
 fi
 
+# galaxy_upload_watcher entrypoint: tracks pending Galaxy uploads
+if [ "$1" = 'galaxy_upload_watcher' ]; then
+    info "[Run] Starting galaxy_upload_watcher"
+
+    set -x
+    exec django-admin.py galaxy_upload_watcher --settings="${DJANGO_SETTINGS_MODULE}"
+fi
+
+# celery_beat entrypoint: schedules periodic tasks (see CELERY_BEAT_SCHEDULE)
+if [ "$1" = 'celery_beat' ]; then
+    info "[Run] Starting celery_beat"
+
+    set -x
+    exec celery -A bpaotu beat -l info --schedule="${WRITABLE_DIRECTORY}"/celerybeat-schedule
+fi
+
 
 # runtests entrypoint
 if [ "$1" = 'runtests' ]; then
@@ -259,7 +275,7 @@ if [ "$1" = 'aloe' ]; then
     _aloe "$@"
 fi
 
-warn "[RUN]: Builtin command not provided [tarball|aloe|runtests|runserver|runserver_plus|uwsgi|uwsgi_local]"
+warn "[RUN]: Builtin command not provided [tarball|aloe|runtests|runserver|runserver_plus|uwsgi|uwsgi_local|celery_worker|celery_beat|galaxy_upload_watcher]"
 info "[RUN]: $*"
 
 set -x